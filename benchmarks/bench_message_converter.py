@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark comparing message_to_ordereddict with the compiled serializers, including the
+typed Base64 array encoding.
+
+Requires a sourced ROS 2 environment, run with:
+    python3 benchmarks/bench_message_converter.py
+"""
+import json
+import timeit
+from geometry_msgs.msg import TransformStamped
+from nav_msgs.msg import Odometry
+from rosidl_runtime_py.convert import message_to_ordereddict
+from sensor_msgs.msg import Image, LaserScan
+from std_msgs.msg import Byte, ByteMultiArray
+from tf2_msgs.msg import TFMessage
+from agent import message_converter
+
+
+ITERATIONS = 5000
+
+
+def odometry():
+    msg = Odometry()
+    msg.header.frame_id = 'odom'
+    msg.child_frame_id = 'base_link'
+    msg.pose.pose.position.x = 1.5
+    msg.pose.pose.orientation.w = 1.0
+    msg.pose.covariance = [0.01 * i for i in range(36)]
+    msg.twist.twist.linear.x = 0.25
+    msg.twist.covariance = [0.02 * i for i in range(36)]
+    return msg
+
+
+def tf_message():
+    msg = TFMessage()
+    for i in range(10):
+        transform = TransformStamped()
+        transform.header.frame_id = 'map'
+        transform.child_frame_id = f'link_{i}'
+        transform.transform.translation.x = float(i)
+        transform.transform.rotation.w = 1.0
+        msg.transforms.append(transform)
+    return msg
+
+
+def laser_scan():
+    msg = LaserScan()
+    msg.header.frame_id = 'laser'
+    msg.angle_increment = 0.005
+    msg.range_max = 30.0
+    msg.ranges = [float(i % 300) / 10 for i in range(720)]
+    msg.intensities = [1.0] * 720
+    return msg
+
+
+def image():
+    msg = Image()
+    msg.header.frame_id = 'camera'
+    msg.height = 48
+    msg.width = 64
+    msg.encoding = 'rgb8'
+    msg.step = 64 * 3
+    msg.data = bytes(i % 256 for i in range(48 * 64 * 3))
+    return msg
+
+
+def byte_multi_array():
+    msg = ByteMultiArray()
+    msg.data = [bytes([i % 256]) for i in range(256)]
+    return msg
+
+
+def byte():
+    return Byte(data=b'\x41')
+
+
+def main():
+    messages = (
+        ('nav_msgs/Odometry', odometry()),
+        ('tf2_msgs/TFMessage', tf_message()),
+        ('sensor_msgs/LaserScan', laser_scan()),
+        ('sensor_msgs/Image', image()),
+        ('std_msgs/ByteMultiArray', byte_multi_array()),
+        ('std_msgs/Byte', byte()),
+    )
+    for name, msg in messages:
+        # The agent sends data samples converted like rosidl_runtime_py, so its output is the reference
+        reference = json.dumps(message_to_ordereddict(msg))
+        compiled = json.dumps(message_converter.convert_ros_message_to_dictionary(msg, base64_encoding=False))
+        assert reference == compiled, f'compiled serializer output differs for {name}'
+
+        reference_time = timeit.timeit(lambda: message_to_ordereddict(msg), number=ITERATIONS)
+        compiled_time = timeit.timeit(
+            lambda: message_converter.convert_ros_message_to_dictionary(msg, base64_encoding=False), number=ITERATIONS
+        )
+        typed_time = timeit.timeit(
+            lambda: message_converter.convert_ros_message_to_dictionary(msg, base64_encoding=False, array_encoding='typed'),
+            number=ITERATIONS
+        )
+
+        print(f'{name:<24} reference {reference_time / ITERATIONS * 1e6:8.1f} us  '
+              f'compiled {compiled_time / ITERATIONS * 1e6:8.1f} us  '
+              f'typed arrays {typed_time / ITERATIONS * 1e6:8.1f} us  '
+              f'speedup {reference_time / compiled_time:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
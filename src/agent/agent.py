@@ -1,34 +1,79 @@
+import os
+import re
 import datetime
-from rosidl_runtime_py import message_to_ordereddict
+import time
+import json
+from agent import AIR_PATH
 from agent.logger import AirLogger
-from agent.json_message_converter import convert_ros_message_to_json
+from agent import message_converter
 from agent.mqtt import AirMqtt
-from agent.config import AirConfig
+from agent.config import AirConfig, config_list
 from agent.containers import AirContainers
 from agent.ros.humble import AirRosHumble
-from jsonschema import validate, ValidationError
-from agent.schemas import command_schema, container_update_schema
+from jsonschema import ValidationError
+from agent.schemas import command_validator, container_update_validator, log_config_validator
 from agent.vitals import AirVitals
+from agent.pipeline import AirPipeline
+from agent.dispatcher import AirDispatcher
+from agent.logs import AirLogAggregator, AirLogFilter
+
+
+def encode_data(raw_msg, msg_class, array_encoding, source, stamp):
+    '''
+    Deserialize a data sample and encode its data/ingest payload. Defined at module
+    level so the pipeline can run it in a worker process.
+    '''
+    msg = AirRosHumble.deserialize(raw_msg, msg_class)
+    data = message_converter.convert_ros_message_to_dictionary(
+        msg, base64_encoding=False, array_encoding=array_encoding)
+    return json.dumps({
+        "sent_at": stamp,
+        "source": source,
+        "payload": data
+    })
 
 
 class AirAgent:
 
+    DATA_MODES = ('throttle', 'sample')
+    DATA_ENCODINGS = ('json', 'cdr')
+    DATA_CONFIG_PATH = os.path.join(AIR_PATH, 'data_config.json')
+
     def __init__(self, daemonize: bool, debug: bool) -> None:
         self.config = AirConfig(daemonize, debug).config
-        self.containers = AirContainers(self.config)
-        self.ros = AirRosHumble(self.config, self.on_log)
-        self.mqtt = AirMqtt(self.config, self.on_mqtt_msg)
-        self.vitals = AirVitals(self.config, self.on_vitals)
         self.logger = AirLogger(__name__, self.config).logger
         self.collect_logs = False
         self.collect_vitals = False
         self.data_subscriptions = {}
+        # Created first, so its process pool is set up before the agent starts any threads
+        self.pipeline = AirPipeline(self.config)
+        self.log_aggregator = AirLogAggregator(self.config, self.publish_logs)
+        self.containers = AirContainers(self.config)
+        self.ros = AirRosHumble(self.config, self.on_log)
+        self.prewarm_types()
+        self.vitals = AirVitals(self.config, self.on_vitals, getattr(self.containers, 'docker_client', None))
+        self.dispatcher = AirDispatcher(self.config, self.on_mqtt_msg)
+        self.mqtt = AirMqtt(self.config, self.dispatcher.dispatch)
+        self.containers.watch_events(self.on_container_event)
 
 
     def spin(self):
         self.ros.spin()
 
 
+    def prewarm_types(self):
+        # Resolve the configured types and the ones of the last data configuration up front
+        type_names = config_list(self.config['ros']['preload_types'])
+        try:
+            with open(self.DATA_CONFIG_PATH) as data_config_file:
+                type_names += [stream['type'] for stream in json.load(data_config_file)]
+        except FileNotFoundError:
+            pass
+        except:
+            self.logger.exception('unable to read the last data configuration')
+        self.ros.prewarm_types(list(dict.fromkeys(type_names)))
+
+
     # Callback handler for mqtt msg
     def on_mqtt_msg(self, topic, data):
         if topic == 'commands/send': 
@@ -42,108 +87,192 @@ class AirAgent:
             self.mqtt.pub(self.mqtt.bot_to_cloud_topics['container_confirm'], result, 0)
         
         elif topic == 'logs/config':
-            should_collect = data['enabled']
-            self.logger.info(f'updating log configuration to {should_collect}')
-            self.collect_logs = should_collect
+            self.configure_logs(data)
         
         elif topic == 'vitals/config':
             should_collect = data['enabled']
             self.logger.info(f'updating vitals configuration to {should_collect}')
             self.collect_vitals = should_collect
+            self.vitals.set_publishing(should_collect)
 
         elif topic == 'data/config':
-            self.ros.clear_data_subscriptions()
-            self.data_subscriptions = {}
-            
-            for stream in data:
-                source = stream['source']
-                msg_type = stream['type']
-                hz = stream['hz']
-                self.data_subscriptions[source] = {
-                    'msg_type': source,
-                    'hz': hz,
-                    'last_sent': None
-                }
-                self.ros.subscribe(source, msg_type, lambda msg, source=source: self.on_data_callback(msg, source))
-                self.logger.info(f'subscribing to {source}') 
-
-            self.logger.info(f'updating data configuration')
+            self.configure_data(data)
 
         else:
             self.logger.error(f"unhandled mqtt msg for topic: {topic}")
 
 
-    def on_data_callback(self, msg, source):
+    def configure_logs(self, data):
+        try:
+            log_config_validator.validate(data)
+            log_filter = AirLogFilter(data)
+        except (ValidationError, re.error):
+            self.logger.exception('invalid log configuration')
+            return
 
-        last_sent = self.data_subscriptions[source]['last_sent']
-        now = datetime.datetime.now()
-        send = False
+        should_collect = data['enabled']
+        self.logger.info(f'updating log configuration to {should_collect}')
+        self.ros.set_log_filter(log_filter)
+        self.collect_logs = should_collect
 
-        if not last_sent:
-            self.data_subscriptions[source]['last_sent'] = now
-            send = True
-        
-        diff = (now - self.data_subscriptions[source]['last_sent']).total_seconds()*1000
-        period = (1 / self.data_subscriptions[source]['hz'])*1000
 
-        if diff > period:
-            self.data_subscriptions[source]['last_sent'] = datetime.datetime.now()
-            send = True
+    def configure_data(self, data):
+        self.ros.clear_data_subscriptions()
+        self.data_subscriptions = {}
+
+        try:
+            with open(self.DATA_CONFIG_PATH, 'w') as data_config_file:
+                json.dump(data, data_config_file)
+        except OSError:
+            self.logger.exception('unable to persist the data configuration')
 
-        if send:
-            stamp = datetime.datetime.now().isoformat() + 'Z'
+        for stream in data:
+            source = stream['source']
+            msg_type = stream['type']
+            hz = stream['hz']
+            if not isinstance(hz, (int, float)) or isinstance(hz, bool) or hz <= 0:
+                self.logger.error(f'unsupported rate {hz} for {source}, skipping stream')
+                continue
+            mode = stream.get('mode', 'throttle')
+            if mode not in self.DATA_MODES:
+                self.logger.error(f'unsupported mode {mode} for {source}, using throttle')
+                mode = 'throttle'
+            encoding = stream.get('encoding', 'json')
+            if encoding not in self.DATA_ENCODINGS:
+                self.logger.error(f'unsupported encoding {encoding} for {source}, using json')
+                encoding = 'json'
+            array_encoding = stream.get('array_encoding', 'list')
+            if array_encoding not in message_converter.ARRAY_ENCODINGS:
+                self.logger.error(f'unsupported array encoding {array_encoding} for {source}, using list')
+                array_encoding = 'list'
 
+            # Resolve the type before subscribing, callbacks run on executor threads as soon as the
+            # subscription exists and need the class and hash of the stream
             try:
-                data = message_to_ordereddict(msg)
+                msg_class = self.ros.registry.resolve(msg_type, 'msg')
+                type_hash = self.ros.type_hash(msg_class)
+            except (ImportError, AttributeError):
+                continue
             except:
-                self.logger.exception('cannot parse ros message')
-                return
+                self.logger.exception(f'unable to resolve the type of {source}')
+                continue
 
-            payload = {
-                "sent_at": stamp,
-                "source": source,
-                "payload": data
+            self.data_subscriptions[source] = {
+                'msg_type': msg_type,
+                'msg_class': msg_class,
+                'type_hash': type_hash,
+                'hz': hz,
+                'period': 1 / hz,
+                'mode': mode,
+                'encoding': encoding,
+                'array_encoding': array_encoding,
+                'last_sent': None,
+                'latest': None
             }
 
-            self.mqtt.pub(self.mqtt.bot_to_cloud_topics['data_ingest'], payload, 1)
+            # Subscribe raw so only the samples that are sent get deserialized
+            msg_class = self.ros.subscribe(
+                source, msg_type, lambda msg, source=source: self.on_data_callback(msg, source), raw=True)
+            if not msg_class:
+                del self.data_subscriptions[source]
+                continue
+
+            if mode == 'sample':
+                self.ros.create_data_timer(source, 1 / hz, lambda source=source: self.on_data_timer(source))
+            self.logger.info(f'subscribing to {source}') 
+
+        self.logger.info(f'updating data configuration')
+
+
+    def on_data_callback(self, raw_msg, source):
+
+        # The stream may have been removed by a new data configuration after this callback was dispatched
+        stream = self.data_subscriptions.get(source)
+        if stream is None:
+            return
+
+        # In sample mode the stream timer sends the latest message at the configured rate
+        if stream['mode'] == 'sample':
+            stream['latest'] = raw_msg
+            return
+
+        now = time.monotonic()
+        if stream['last_sent'] is not None and now - stream['last_sent'] <= stream['period']:
+            return
+
+        stream['last_sent'] = now
+        self.send_data(raw_msg, source)
+
+
+    def on_data_timer(self, source):
+        stream = self.data_subscriptions.get(source)
+        if stream is None:
+            return
+        raw_msg = stream['latest']
+
+        # Only send samples that arrived since the last tick
+        if raw_msg is None:
+            return
+
+        stream['latest'] = None
+        self.send_data(raw_msg, source)
+
+
+    def send_data(self, raw_msg, source):
+
+        stream = self.data_subscriptions.get(source)
+        if stream is None:
+            return
+        stamp = datetime.datetime.now().isoformat() + 'Z'
+
+        if stream['encoding'] == 'cdr':
+            # Forward the CDR bytes as received, the cloud decodes them using the type headers
+            headers = [
+                ('air-encoding', 'cdr'),
+                ('air-source', source),
+                ('air-type', stream['msg_type']),
+                ('air-type-hash', stream['type_hash']),
+                ('air-sent-at', stamp)
+            ]
+            self.mqtt.pub(self.mqtt.bot_to_cloud_topics['data_ingest'], raw_msg, 1, headers, source)
+            return
+
+        # Deserialize, convert and publish on a pipeline worker, keyed by source to keep samples in order
+        args = (raw_msg, stream['msg_class'], stream['array_encoding'], source, stamp)
+        publish = lambda data: self.mqtt.pub_json(self.mqtt.bot_to_cloud_topics['data_ingest'], data, 1, source=source)
+        if not self.pipeline.submit(source, encode_data, args, publish, process=True):
+            self.logger.warning(f'pipeline full, dropped sample from {source}')
 
 
     # Callback handler for ros log msg
     def on_log(self, msg):
+        if self.collect_logs or self.config['debug']:
+            self.log_aggregator.add(msg)
 
-        def ros_level(level: int):
-            if level==10: return 'debug'
-            elif level==20: return 'info'
-            elif level==30: return 'warn'
-            elif level==40: return 'error'
-            if level==50: return 'fatal'
-
-        stamp = datetime.datetime.utcfromtimestamp(msg.stamp._sec).isoformat() + 'Z'
-
-        log_msg = {
-            'msg': msg.msg,
-            'level': ros_level(msg.level),
-            'name': msg.name,
-            'file': msg.file,
-            'function': msg.function,
-            'line': msg.line,
-            'stamp': stamp
-        }
-        self.logger.debug(log_msg)
-        
+
+    def publish_logs(self, log_msgs):
+        self.logger.debug(f'collected {len(log_msgs)} log entries')
         if self.collect_logs:
-            self.mqtt.pub(self.mqtt.bot_to_cloud_topics['logs_ingest'], log_msg, 1)
-        
+            self.mqtt.pub(self.mqtt.bot_to_cloud_topics['logs_ingest'], log_msgs, 1, [('air-batch', str(len(log_msgs)))])
+
+
+    def on_container_event(self, event):
+        self.mqtt.pub(self.mqtt.bot_to_cloud_topics['container_events'], event, 1)
+
 
     def on_vitals(self, vitals):
         if self.collect_vitals:
+            # Agent stats change on every message, send them with the full vitals only
+            if vitals['full']:
+                vitals = dict(vitals, publish_queue=self.mqtt.publish_queue.stats(), pipeline=self.pipeline.stats(),
+                              logs=self.log_aggregator.stats())
             self.mqtt.pub(self.mqtt.bot_to_cloud_topics['vitals_ingest'], vitals, 0)
     
 
     def handle_cmd(self, data):
         
         try:
-            validate(instance=data, schema=command_schema)
+            command_validator.validate(data)
         except ValidationError as e:
             self.logger.exception("invalid command schema")
             return { 'success': False, 'failure_reason': 'unknown_error' }
@@ -160,7 +289,7 @@ class AirAgent:
 
     def handle_container_update(self, data):
         try:
-            validate(instance=data, schema=container_update_schema)
+            container_update_validator.validate(data)
         except ValidationError as e:
             self.logger.exception("invalid container_update_schema")
             return { 'success': False, 'failure_reason': 'unknown_error' }
@@ -169,5 +298,7 @@ class AirAgent:
             return self.containers.remove_compose()
         
         else:
-            return self.containers.put_compose(data['compose'])
+            on_status = lambda status: self.mqtt.pub(self.mqtt.bot_to_cloud_topics['container_status'],
+                                                     dict(status, uuid=data['uuid']), 0, source=data['uuid'])
+            return self.containers.put_compose(data['compose'], on_status)
         
@@ -0,0 +1,86 @@
+import time
+import threading
+from agent.logger import AirLogger
+
+
+class AirBatcher:
+    """
+    Groups JSON payloads published on the same short topic into a single JSON array.
+
+    A batch is flushed when it holds max_count messages, when adding a message would
+    take it over max_bytes or when it has been open for max_latency seconds.
+    """
+
+    def __init__(self, config, on_flush) -> None:
+        self.logger = AirLogger(__name__, config).logger
+        self.on_flush = on_flush
+        self.max_count = int(config['batching']['max_count'])
+        self.max_bytes = int(config['batching']['max_bytes'])
+        self.max_latency = float(config['batching']['max_latency'])
+        self.batches = {}
+        self.condition = threading.Condition()
+
+        flush_thread = threading.Thread(target=self.flush_expired, daemon=True)
+        flush_thread.start()
+
+
+    def add(self, short_topic, data: str, qos: int):
+        ready = []
+
+        with self.condition:
+            batch = self.batches.get(short_topic)
+
+            if batch and batch['bytes'] + len(data) + 1 > self.max_bytes:
+                ready.append(self.close(short_topic))
+                batch = None
+
+            if batch is None:
+                batch = { 'items': [], 'bytes': 2, 'qos': qos, 'deadline': time.monotonic() + self.max_latency }
+                self.batches[short_topic] = batch
+                self.condition.notify()
+
+            batch['items'].append(data)
+            batch['bytes'] += len(data) + 1
+            batch['qos'] = max(batch['qos'], qos)
+
+            if len(batch['items']) >= self.max_count or batch['bytes'] >= self.max_bytes:
+                ready.append(self.close(short_topic))
+
+        # Publish outside of the lock so producers are not blocked by the network
+        for flushed in ready:
+            self.flush(*flushed)
+
+
+    def close(self, short_topic):
+        batch = self.batches.pop(short_topic)
+        return short_topic, batch['items'], batch['qos']
+
+
+    def flush(self, short_topic, items, qos):
+        payload = '[' + ','.join(items) + ']'
+        self.on_flush(short_topic, payload, qos, [('air-batch', str(len(items)))])
+        self.logger.debug(f'flushed batch of {len(items)} messages on {short_topic}')
+
+
+    def flush_expired(self):
+        while True:
+            ready = []
+
+            with self.condition:
+                while not self.batches:
+                    self.condition.wait()
+
+                now = time.monotonic()
+                for short_topic, batch in list(self.batches.items()):
+                    if batch['deadline'] <= now:
+                        ready.append(self.close(short_topic))
+
+                if not ready:
+                    next_deadline = min(batch['deadline'] for batch in self.batches.values())
+                    self.condition.wait(next_deadline - now)
+
+            for flushed in ready:
+                try:
+                    self.flush(*flushed)
+                except:
+                    self.logger.exception(f'failed to flush batch on {flushed[0]}')
@@ -0,0 +1,74 @@
+import zlib
+import hashlib
+from agent.logger import AirLogger
+
+
+class AirCompressor:
+    """
+    Compresses outbound payloads with zlib and decompresses inbound ones.
+
+    Compressed payloads are flagged with the air-content-encoding user property. When a
+    preset dictionary is configured, its id is sent as air-zdict so the receiver can pick
+    the same dictionary. A good dictionary is a few KB of representative payloads with
+    the most common content at the end.
+    """
+
+    ENCODING = 'zlib'
+
+    def __init__(self, config) -> None:
+        self.logger = AirLogger(__name__, config).logger
+        self.min_bytes = int(config['compression']['min_bytes'])
+        self.level = int(config['compression']['level'])
+        self.zdict = None
+        self.zdict_id = None
+
+        if config['compression']['dictionary']:
+            try:
+                with open(config['compression']['dictionary'], 'rb') as dictionary_file:
+                    self.zdict = dictionary_file.read()
+                self.zdict_id = hashlib.sha256(self.zdict).hexdigest()[:16]
+                self.logger.debug(f'loaded compression dictionary {self.zdict_id}')
+            except OSError:
+                self.logger.exception('unable to load compression dictionary')
+
+
+    def compress(self, data):
+        '''
+        Returns the payload to send and the user properties describing it. Payloads smaller
+        than min_bytes are returned unchanged as compressing them does not pay off.
+        '''
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        if len(data) < self.min_bytes:
+            return data, []
+
+        if self.zdict:
+            compressor = zlib.compressobj(self.level, zdict=self.zdict)
+            properties = [('air-content-encoding', self.ENCODING), ('air-zdict', self.zdict_id)]
+        else:
+            compressor = zlib.compressobj(self.level)
+            properties = [('air-content-encoding', self.ENCODING)]
+
+        return compressor.compress(data) + compressor.flush(), properties
+
+
+    def decompress(self, payload, user_properties):
+        properties = dict(user_properties)
+        encoding = properties.get('air-content-encoding')
+
+        if encoding is None:
+            return payload
+
+        if encoding != self.ENCODING:
+            raise ValueError(f'unsupported content encoding {encoding}')
+
+        zdict_id = properties.get('air-zdict')
+        if zdict_id is None:
+            return zlib.decompress(payload)
+
+        if zdict_id != self.zdict_id:
+            raise ValueError(f'unknown compression dictionary {zdict_id}')
+
+        decompressor = zlib.decompressobj(zdict=self.zdict)
+        return decompressor.decompress(payload) + decompressor.flush()
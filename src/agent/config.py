@@ -22,7 +22,12 @@ class AirConfig:
         'enable_containers': True,
         'enable_vitals': True,
         'ros': {
-            'distro': ''
+            'distro': '',
+            'executor_threads': 4,
+            'entity_cache_size': 64,
+            'entity_idle_timeout': 300,
+            'discovery_timeout': 1.0,
+            'preload_types': ''
         },
         'mqtt': {
             'host': 'o526e215.eu-central-1.emqx.cloud',
@@ -33,6 +38,76 @@ class AirConfig:
             'url': 'https://index.docker.io/v1/',
             'username': '',
             'password': ''
+        },
+        'containers': {
+            'pull_concurrency': 3,
+            'pull_retries': 3
+        },
+        'batching': {
+            'topics': '',
+            'max_count': 100,
+            'max_bytes': 65536,
+            'max_latency': 1.0
+        },
+        'compression': {
+            'topics': '',
+            'min_bytes': 512,
+            'level': 6,
+            'dictionary': ''
+        },
+        'offline': {
+            'topics': 'data_ingest,logs_ingest',
+            'max_bytes': 104857600,
+            'drain_rate': 50
+        },
+        'publish_queue': {
+            'max_inflight': 20,
+            'control_capacity': 1000,
+            'control_policy': 'drop_oldest',
+            'presence_capacity': 10,
+            'presence_policy': 'drop_oldest',
+            'events_capacity': 200,
+            'events_policy': 'drop_oldest',
+            'status_capacity': 10,
+            'status_policy': 'keep_latest',
+            'logs_capacity': 1000,
+            'logs_policy': 'drop_oldest',
+            'data_capacity': 500,
+            'data_policy': 'keep_latest',
+            'vitals_capacity': 10,
+            'vitals_policy': 'drop_oldest',
+            'backlog_capacity': 100,
+            'backlog_policy': 'drop_newest'
+        },
+        'vitals': {
+            'period': 1.0,
+            'cpu_period': 1,
+            'ram_period': 1,
+            'disk_period': 30,
+            'battery_period': 30,
+            'local_ip_period': 300,
+            'public_ip_period': 300,
+            'public_ip_timeout': 5,
+            'series_period': 1,
+            'window': 60,
+            'keyframe_period': 300,
+            'min_change': 1.0,
+            'processes_period': 5,
+            'containers_period': 10,
+            'process_scan_period': 30,
+            'top_n': 5
+        },
+        'logs': {
+            'queue_depth': 100,
+            'window': 1.0,
+            'max_entries': 500,
+            'rate': 10,
+            'burst': 50
+        },
+        'pipeline': {
+            'mode': 'thread',
+            'workers': 2,
+            'max_depth': 1000
         }
     }
 
@@ -84,4 +159,13 @@ class AirConfig:
             return True
         elif val in ('False', 'false', 0):
             return False
-        return val
\ No newline at end of file
+        return val
+
+
+def config_list(val):
+    """
+    List values can be set as a TOML array or as a comma separated string in the env
+    """
+    if isinstance(val, str):
+        return [item.strip() for item in val.split(',') if item.strip()]
+    return list(val)
@@ -1,6 +1,8 @@
 import sys
 import os
+import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import docker
 from docker.models.images import Image
 from docker.models.containers import Container
@@ -8,16 +10,40 @@ from agent import AIR_PATH
 from agent.logger import AirLogger
 import subprocess
 import json
+import hashlib
 
 class AirContainers:
 
     # AIR_DEV_REPOSITORY = "airbotics/agent"
     COMPOSE_PATH = os.path.join(AIR_PATH, "docker-compose.json")
 
+    # Container state after each reported event, None for events that do not change the state
+    EVENT_STATES = {
+        'create': 'created',
+        'start': 'running',
+        'restart': 'running',
+        'unpause': 'running',
+        'pause': 'paused',
+        'die': 'exited',
+        'oom': None,
+        'health_status': None,
+        'destroy': 'removed'
+    }
+
+    # Minimum seconds between pull progress reports
+    PULL_REPORT_PERIOD = 1
+
+    # Seconds to wait before reconnecting to the docker events stream
+    EVENTS_RETRY_DELAY = 1
+
 
     def __init__(self, config) -> None:
 
         self.logger = AirLogger(__name__, config).logger
+        self.container_states = {}
+        self.states_lock = threading.Lock()
+        self.pull_concurrency = max(1, int(config['containers']['pull_concurrency']))
+        self.pull_retries = max(1, int(config['containers']['pull_retries']))
 
         if config['enable_containers'] == False:
             self.logger.info('containers not enabled')
@@ -43,17 +69,18 @@ class AirContainers:
 
         self.start_containers()
 
-        # Start a background thread to listen for docker events
-        # event_thread = threading.Thread(target=self.listen_for_events, daemon=True)
-        # event_thread.start()
 
-
-    def start_containers(self) -> dict:
+    def start_containers(self, remove_orphans=False, pull_never=False) -> dict:
         
         # If there's a docker-compose present, try and up it 
         if os.path.exists(self.COMPOSE_PATH):
             self.logger.info(f'attempting docker compose up')
-            up_res= subprocess.run(['docker', 'compose', '-f', self.COMPOSE_PATH, 'up', '-d'], capture_output=True, text=True)
+            up_args = ['docker', 'compose', '-f', self.COMPOSE_PATH, 'up', '-d']
+            if remove_orphans:
+                up_args.append('--remove-orphans')
+            if pull_never:
+                up_args += ['--pull', 'never']
+            up_res= subprocess.run(up_args, capture_output=True, text=True)
             if up_res.returncode != 0:
                 self.logger.error(up_res.stderr)
                 return { 'state': 'error', 'error_code': 'compose_up' }
@@ -65,19 +92,141 @@ class AirContainers:
 
 
     
-    def put_compose(self, compose_json) -> dict:
-        
-        # If theres already a docker-compose, attempt to down it
-        remove_res = self.remove_compose()
+    def put_compose(self, compose_json, on_status=None) -> dict:
+        '''
+        Reconcile the running stack with a new compose. All images of the new compose are
+        pulled first while the current stack keeps running, pull progress is reported to
+        on_status. Services are then compared by the hash of their definition, compose only
+        recreates the ones that changed and removes the ones that are gone, the others keep
+        running. Images no longer referenced are removed.
+        '''
+        if not self.pull_images(self.compose_images(compose_json), on_status):
+            return { 'state': 'error', 'error_code': 'image_pull' }
+
+        previous_json = self.read_compose()
+        previous_hashes = self.service_hashes(previous_json)
+        hashes = self.service_hashes(compose_json)
+
+        services = {
+            'created': sorted(name for name in hashes if name not in previous_hashes),
+            'updated': sorted(name for name in hashes if name in previous_hashes and hashes[name] != previous_hashes[name]),
+            'removed': sorted(name for name in previous_hashes if name not in hashes),
+            'unchanged': sorted(name for name in hashes if hashes[name] == previous_hashes.get(name))
+        }
+        self.logger.info(f"reconciling compose, created: {services['created']}, updated: {services['updated']}, "
+                         f"removed: {services['removed']}")
 
-        if(remove_res['state'] == 'error'):
-            return remove_res
-        
         # write or overwrite the new compose
         with open(self.COMPOSE_PATH, 'w') as compose_file:
             json.dump(compose_json, compose_file)
 
-        return self.start_containers()
+        result = self.start_containers(remove_orphans=True, pull_never=True)
+        result['services'] = services
+        if result['state'] == 'up':
+            self.remove_images(self.compose_images(previous_json) - self.compose_images(compose_json))
+            # Drop the layers of images whose tags were moved by the pull
+            try:
+                self.docker_client.images.prune(filters={ 'dangling': True })
+            except docker.errors.APIError as e:
+                self.logger.warning(f'unable to prune dangling images: {e}')
+        return result
+
+
+    def pull_images(self, images, on_status=None) -> bool:
+        '''
+        Pull images in parallel, at most pull_concurrency at a time. Layers that are already
+        local are not downloaded again, so a failed pull is retried from where it stopped.
+        '''
+        progress = { image: { 'status': 'waiting', 'current': 0, 'total': 0 } for image in images }
+        lock = threading.Lock()
+        last_report = [0]
+
+        def report(force=False):
+            if on_status is None:
+                return
+            with lock:
+                now = time.monotonic()
+                if not force and now - last_report[0] < self.PULL_REPORT_PERIOD:
+                    return
+                last_report[0] = now
+                status = { 'stage': 'pull', 'images': { image: dict(entry) for image, entry in progress.items() } }
+            try:
+                on_status(status)
+            except:
+                self.logger.exception('failed to report pull progress')
+
+        def pull(image):
+            layers = {}
+            for attempt in range(1, self.pull_retries + 1):
+                try:
+                    with lock:
+                        progress[image]['status'] = 'pulling'
+                    for event in self.docker_client.api.pull(image, stream=True, decode=True):
+                        if 'error' in event:
+                            raise docker.errors.APIError(event['error'])
+                        detail = event.get('progressDetail') or {}
+                        if event.get('id') and detail.get('total'):
+                            layers[event['id']] = (detail.get('current', 0), detail['total'])
+                            with lock:
+                                progress[image]['current'] = sum(current for current, _ in layers.values())
+                                progress[image]['total'] = sum(total for _, total in layers.values())
+                        report()
+                    with lock:
+                        progress[image]['status'] = 'pulled'
+                    self.logger.info(f'pulled image {image}')
+                    return True
+                except Exception as e:
+                    self.logger.warning(f'pull of image {image} failed, attempt {attempt} of {self.pull_retries}: {e}')
+                    time.sleep(min(2 ** attempt, 30) if attempt < self.pull_retries else 0)
+
+            with lock:
+                progress[image]['status'] = 'failed'
+            return False
+
+        with ThreadPoolExecutor(self.pull_concurrency) as executor:
+            results = list(executor.map(pull, sorted(images)))
+
+        report(force=True)
+        return all(results)
+
+
+    def read_compose(self):
+        try:
+            with open(self.COMPOSE_PATH) as compose_file:
+                return json.load(compose_file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            self.logger.exception('unable to read the current compose')
+            return None
+
+
+    def service_hashes(self, compose_json):
+        if not compose_json:
+            return {}
+        return {
+            name: hashlib.sha256(json.dumps(service, sort_keys=True).encode('utf-8')).hexdigest()
+            for name, service in (compose_json.get('services') or {}).items()
+        }
+
+
+    def compose_images(self, compose_json):
+        if not compose_json:
+            return set()
+        return { service['image'] for service in (compose_json.get('services') or {}).values() if service.get('image') }
+
+
+    def remove_images(self, images):
+        for image in images:
+            try:
+                self.docker_client.images.remove(image)
+                self.logger.info(f'removed image {image}')
+            except docker.errors.ImageNotFound:
+                pass
+            except docker.errors.APIError as e:
+                # Still used by a container outside of the compose
+                self.logger.warning(f'unable to remove image {image}: {e}')
+
 
     def remove_compose(self) -> dict:
         if os.path.exists(self.COMPOSE_PATH):
@@ -126,12 +275,90 @@ class AirContainers:
     #     self.logger.info("attempting to pull image")
 
     
-    # def listen_for_events(self):
-    #     for event in self.docker_client.events(decode=True):
-    #         if event["Type"] == "container":
-    #             self.logger.info(f"container event received")
-    #         else:
-    #             self.logger.debug(f"docker event type {event['Type']}, ignored")
+    def watch_events(self, on_event):
+        '''
+        Keep the container state table up to date from the docker events stream and report
+        every state transition to on_event as it happens, without polling the daemon.
+        '''
+        if not hasattr(self, 'docker_client'):
+            return
+        self.on_event = on_event
+        event_thread = threading.Thread(target=self.listen_for_events, daemon=True)
+        event_thread.start()
+
+
+    def listen_for_events(self):
+        since = None
+        last_nano = 0
+
+        while True:
+            try:
+                if since is None:
+                    since = int(time.time())
+                    self.load_container_states()
+                # Resume from the second of the last event seen, so no transition is missed while
+                # reconnecting, and skip the events of that second which were already handled
+                for event in self.docker_client.events(decode=True, since=since, filters={ 'type': 'container' }):
+                    event_nano = event.get('timeNano', 0)
+                    if event_nano and event_nano <= last_nano:
+                        continue
+                    since = event.get('time', since)
+                    last_nano = event_nano or last_nano
+                    self.handle_event(event)
+            except:
+                self.logger.exception('docker events stream failed, reconnecting')
+            time.sleep(self.EVENTS_RETRY_DELAY)
+
+
+    def load_container_states(self):
+        states = {}
+        for container in self.docker_client.containers.list(all=True):
+            states[container.id] = {
+                'name': container.name,
+                'image': container.attrs['Config']['Image'],
+                'state': container.status,
+                'health': container.attrs['State'].get('Health', {}).get('Status'),
+                'exit_code': container.attrs['State'].get('ExitCode')
+            }
+        with self.states_lock:
+            self.container_states = states
+        self.logger.debug(f'loaded the state of {len(states)} containers')
+
+
+    def handle_event(self, event):
+        action = event.get('Action', '')
+        if action.startswith('health_status: '):
+            action, health = 'health_status', action[len('health_status: '):]
+        if action not in self.EVENT_STATES:
+            return
+
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        container_id = event.get('id') or event.get('Actor', {}).get('ID')
+
+        with self.states_lock:
+            state = self.container_states.setdefault(container_id, {
+                'name': attributes.get('name'),
+                'image': attributes.get('image'),
+                'state': None,
+                'health': None,
+                'exit_code': None
+            })
+            if action == 'health_status':
+                state['health'] = health
+            elif self.EVENT_STATES[action]:
+                state['state'] = self.EVENT_STATES[action]
+            if action == 'die':
+                state['exit_code'] = int(attributes.get('exitCode', 0))
+
+            transition = dict(state, id=container_id, event=action, time=event.get('time'))
+            if action == 'destroy':
+                del self.container_states[container_id]
+
+        self.logger.debug(f"container {transition['name']} {action}")
+        try:
+            self.on_event(transition)
+        except:
+            self.logger.exception('failed to report container event')
 
 
     '''
@@ -0,0 +1,47 @@
+import queue
+import threading
+from agent.logger import AirLogger
+
+
+class AirDispatcher:
+    """
+    Hands messages received from the cloud to per interface worker threads.
+
+    The MQTT network thread only decodes and enqueues, so slow handlers like a docker
+    compose up never block keepalives or acknowledgements. Each interface has a single
+    worker, so messages on the same topic are handled in the order they arrived.
+    """
+
+    interfaces = {
+        'commands/send': 'commands',
+        'containers/config': 'containers',
+        'logs/config': 'config',
+        'vitals/config': 'config',
+        'data/config': 'config'
+    }
+
+    def __init__(self, config, on_msg) -> None:
+        self.logger = AirLogger(__name__, config).logger
+        self.on_msg = on_msg
+        self.queues = {}
+
+        for interface in set(self.interfaces.values()):
+            messages = queue.Queue()
+            self.queues[interface] = messages
+            worker_thread = threading.Thread(target=self.run, args=(interface, messages), daemon=True)
+            worker_thread.start()
+
+
+    def dispatch(self, topic, data):
+        interface = self.interfaces.get(topic, 'config')
+        self.queues[interface].put((topic, data))
+        self.logger.debug(f'dispatched {topic} to {interface} worker')
+
+
+    def run(self, interface, messages):
+        while True:
+            topic, data = messages.get()
+            try:
+                self.on_msg(topic, data)
+            except:
+                self.logger.exception(f'{interface} worker failed to handle {topic}')
@@ -0,0 +1,194 @@
+import re
+import time
+import fnmatch
+import datetime
+import threading
+from agent.logger import AirLogger
+
+
+class AirLogAggregator:
+    """
+    Collects /rosout messages into time windows before they are published.
+
+    Consecutive identical messages from a node are folded into a single entry with a count
+    and the stamps of the first and last occurrence. Every node has a token bucket refilled
+    at rate messages per second up to burst, entries beyond it are dropped and only counted,
+    so a node spamming warnings cannot saturate the uplink. Every window seconds the pending
+    entries are handed to on_flush as a list of dictionaries, at most max_entries per window.
+    """
+
+    LEVELS = { 10: 'debug', 20: 'info', 30: 'warn', 40: 'error', 50: 'fatal' }
+
+    def __init__(self, config, on_flush) -> None:
+        self.logger = AirLogger(__name__, config).logger
+        self.on_flush = on_flush
+        self.window = float(config['logs']['window'])
+        self.max_entries = int(config['logs']['max_entries'])
+        self.rate = float(config['logs']['rate'])
+        self.burst = float(config['logs']['burst'])
+        self.lock = threading.Lock()
+        self.entries = []
+        self.last_entries = {}
+        self.buckets = {}
+        self.dropped = {}
+        self.folded = 0
+        self.total_dropped = 0
+
+        flush_thread = threading.Thread(target=self.run, daemon=True)
+        flush_thread.start()
+
+
+    def add(self, msg):
+        # Runs on the ROS executor, so only the raw fields are kept until the window is flushed
+        key = (msg.level, msg.msg, msg.file, msg.function, msg.line)
+        stamp = msg.stamp.sec + msg.stamp.nanosec / 1e9
+
+        with self.lock:
+            entry = self.last_entries.get(msg.name)
+            if entry is not None and entry['key'] == key:
+                entry['count'] += 1
+                entry['last_stamp'] = stamp
+                self.folded += 1
+                return
+
+            # Only entries that are buffered take a token, so dropped ones do not use up the budget
+            if len(self.entries) >= self.max_entries or not self.take_token(msg.name):
+                self.dropped[msg.name] = self.dropped.get(msg.name, 0) + 1
+                self.total_dropped += 1
+                return
+
+            entry = { 'key': key, 'name': msg.name, 'count': 1, 'stamp': stamp, 'last_stamp': stamp }
+            self.entries.append(entry)
+            self.last_entries[msg.name] = entry
+
+
+    def take_token(self, name):
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(name, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        if tokens < 1:
+            self.buckets[name] = (tokens, now)
+            return False
+
+        self.buckets[name] = (tokens - 1, now)
+        return True
+
+
+    def run(self):
+        while True:
+            time.sleep(self.window)
+
+            with self.lock:
+                entries = self.entries
+                dropped = self.dropped
+                self.entries = []
+                self.last_entries = {}
+                self.dropped = {}
+
+            if dropped:
+                self.logger.warning(f'rate limited logs from {dropped}')
+            if not entries:
+                continue
+
+            try:
+                self.on_flush([self.encode(entry) for entry in entries])
+            except:
+                self.logger.exception('failed to flush logs')
+
+
+    def encode(self, entry):
+        level, msg, file, function, line = entry['key']
+        return {
+            'msg': msg,
+            'level': self.LEVELS.get(level),
+            'name': entry['name'],
+            'file': file,
+            'function': function,
+            'line': line,
+            'stamp': self.format_stamp(entry['stamp']),
+            'last_stamp': self.format_stamp(entry['last_stamp']),
+            'count': entry['count']
+        }
+
+
+    def format_stamp(self, stamp):
+        return datetime.datetime.utcfromtimestamp(stamp).isoformat() + 'Z'
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': len(self.entries),
+                'folded': self.folded,
+                'dropped': self.total_dropped
+            }
+
+
+class AirLogFilter:
+    """
+    Decides which /rosout messages are collected, compiled once from a logs/config message:
+        level:             minimum level, one of debug, info, warn, error or fatal
+        node_levels:       minimum level per node name pattern, overriding level
+        nodes:             node name patterns to collect, all nodes when empty
+        exclude_nodes:     node name patterns never collected
+        messages:          regexes of which at least one must match the message, any message when empty
+        exclude_messages:  regexes of which none may match the message
+
+    Node name patterns use shell wildcards, e.g. /nav2/*. The minimum level of every node
+    name is resolved once and cached, so most messages are decided with a dictionary lookup
+    and an integer comparison.
+    """
+
+    LEVELS = { 'debug': 10, 'info': 20, 'warn': 30, 'error': 40, 'fatal': 50 }
+
+    # Level that no message reaches, used for nodes that are not collected
+    DISABLED = 100
+
+    def __init__(self, data) -> None:
+        self.level = self.LEVELS[data.get('level', 'debug')]
+        self.node_levels = [(self.compile_patterns([pattern]), self.LEVELS[level])
+                            for pattern, level in data.get('node_levels', {}).items()]
+        self.nodes = self.compile_patterns(data.get('nodes', []))
+        self.exclude_nodes = self.compile_patterns(data.get('exclude_nodes', []))
+        self.messages = self.compile_regexes(data.get('messages', []))
+        self.exclude_messages = self.compile_regexes(data.get('exclude_messages', []))
+        self.node_min_levels = {}
+
+
+    def compile_patterns(self, patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns))
+
+
+    def compile_regexes(self, regexes):
+        if not regexes:
+            return None
+        return re.compile('|'.join(f'(?:{regex})' for regex in regexes))
+
+
+    def matches(self, msg) -> bool:
+        min_level = self.node_min_levels.get(msg.name)
+        if min_level is None:
+            min_level = self.node_min_level(msg.name)
+
+        if msg.level < min_level:
+            return False
+        if self.messages and not self.messages.search(msg.msg):
+            return False
+        if self.exclude_messages and self.exclude_messages.search(msg.msg):
+            return False
+        return True
+
+
+    def node_min_level(self, name):
+        if self.exclude_nodes and self.exclude_nodes.match(name):
+            min_level = self.DISABLED
+        elif self.nodes and not self.nodes.match(name):
+            min_level = self.DISABLED
+        else:
+            min_level = next((level for pattern, level in self.node_levels if pattern.match(name)), self.level)
+
+        self.node_min_levels[name] = min_level
+        return min_level
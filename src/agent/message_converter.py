@@ -18,13 +18,21 @@
 
 import array
 import base64
+import threading
 from collections import OrderedDict
-from typing import Any, Dict, Text
+from typing import Any, Callable, Dict, Text
 
 import numpy as np
 import rosidl_parser.definition
-from rosidl_parser.definition import AbstractNestedType, NamespacedType, Array, UnboundedSequence, BasicType
-from rosidl_runtime_py.convert import get_message_slot_types
+from rosidl_parser.definition import (
+    AbstractNestedType,
+    AbstractString,
+    AbstractWString,
+    NamespacedType,
+    Array,
+    UnboundedSequence,
+    BasicType,
+)
 from rosidl_runtime_py.import_message import import_message_from_namespaced_type
 from rosidl_runtime_py.utilities import get_message, get_service
 
@@ -98,7 +106,8 @@ def set_message_fields(
     """
     Set the fields of a ROS message.
 
-    This method was copied and modified from rosidl_runtime_py.set_message.set_message_fields .
+    This method was copied and modified from rosidl_runtime_py.set_message.set_message_fields . The fields are set
+    using the cached plan of the message class, see `compile_message_deserializer`.
 
     :param msg: The ROS message to populate.
     :param values: The values to set in the ROS message. The keys of the dictionary represent
@@ -112,69 +121,20 @@ def set_message_fields(
     :raises ValueError: If the input dictionary is incomplete (i.e., is missing an entry for some field
         of the ROS message).
     """
-    if values is None:
-        values = {}
-    try:
-        items = values.items()
-    except AttributeError:
-        raise TypeError("Value '%s' is expected to be a dictionary but is a %s" % (values, type(values).__name__))
-
-    remaining_message_fields = dict(_get_message_fields(msg))
-
-    for field_name, field_value in items:
-        if field_value is None:
-            continue
-        try:
-            field = getattr(msg, field_name)
-            del remaining_message_fields[field_name]
-        except AttributeError as e:
-            if strict_mode:
-                raise e
-            else:
-                continue
-        field_type = type(field)
-        if field_type is array.array:
-            if isinstance(field_value, (str, bytes)):
-                # If field_value is not properly base64 encoded and there are non-base64-alphabet characters in the
-                # input, a binascii.Error will be raised.
-                field_value = list(base64.b64decode(field_value, validate=True))
-            value = field_type(field.typecode, field_value)
-        elif field_type is np.ndarray:
-            if isinstance(field_value, (str, bytes)):
-                # If field_value is not properly base64 encoded and there are non-base64-alphabet characters in the
-                # input, a binascii.Error will be raised.
-                field_value = list(base64.b64decode(field_value, validate=True))
-            value = np.array(field_value, dtype=field.dtype)
-        elif type(field_value) is field_type:
-            value = field_value
-        else:
-            try:
-                value = field_type(field_value)
-            except TypeError:
-                value = field_type()
-                set_message_fields(value, field_value, strict_mode, check_missing_fields)
-        rosidl_type = get_message_slot_types(msg)[field_name]
-        # Check if field is an array of ROS messages
-        if isinstance(rosidl_type, AbstractNestedType):
-            if isinstance(rosidl_type.value_type, NamespacedType):
-                field_elem_type = import_message_from_namespaced_type(rosidl_type.value_type)
-                for n in range(len(value)):
-                    submsg = field_elem_type()
-                    set_message_fields(submsg, value[n], strict_mode, check_missing_fields)
-                    value[n] = submsg
-        setattr(msg, field_name, value)
-
-    if check_missing_fields and remaining_message_fields:
-        error_message = 'fields in dictionary missing from ROS message: "{0}"'.format(
-            list(remaining_message_fields.keys())
-        )
-        raise ValueError(error_message)
+    get_message_deserializer(type(msg))(msg, values, strict_mode, check_missing_fields)
 
 
-def convert_ros_message_to_dictionary(message: Any, base64_encoding: bool = True) -> OrderedDict:
+def convert_ros_message_to_dictionary(
+    message: Any, base64_encoding: bool = True, array_encoding: str = 'list'
+) -> OrderedDict:
     """
     Takes in a ROS message and returns an OrderedDict.
 
+    :param message: The ROS message to convert.
+    :param base64_encoding: Encode `uint8[]` and `uint8[n]` fields using Base64, see `message_to_ordereddict`.
+        If `False`, the result is identical to `rosidl_runtime_py.convert.message_to_ordereddict`.
+    :param array_encoding: How to serialize arrays of numeric types, one of `ARRAY_ENCODINGS`.
+
     Example:
         >>> import std_msgs.msg
         >>> ros_message = std_msgs.msg.UInt32(data=42)
@@ -182,7 +142,7 @@ def convert_ros_message_to_dictionary(message: Any, base64_encoding: bool = True
         OrderedDict([('data', 42)])
     """
 
-    return message_to_ordereddict(message, base64_encoding=base64_encoding)
+    return get_message_serializer(type(message), base64_encoding, array_encoding)(message)
 
 
 def message_to_ordereddict(
@@ -314,6 +274,360 @@ def _convert_value(
     return value
 
 
+# Maximum number of compiled serializers and deserializers kept in memory, least recently used ones are evicted first.
+SERIALIZER_CACHE_SIZE = 256
+
+# How arrays of numeric basic types are serialized:
+#   'list':  a JSON list of numbers, identical to message_to_ordereddict.
+#   'typed': {'dtype': <numpy dtype string>, 'shape': [<length>], 'data': <Base64 of the little-endian buffer>}.
+ARRAY_ENCODINGS = ('list', 'typed')
+
+_PRIMITIVE_TYPES = frozenset((bool, int, float, str))
+_SEQUENCE_TYPES = frozenset((list, array.array, np.ndarray))
+_BUFFER_TYPES = frozenset((array.array, np.ndarray))
+
+# Little-endian numpy dtypes for the numeric rosidl basic types.
+_NUMPY_DTYPES = {
+    'float': '<f4',
+    'double': '<f8',
+    'short': '<i2',
+    'unsigned short': '<u2',
+    'long': '<i4',
+    'unsigned long': '<u4',
+    'long long': '<i8',
+    'unsigned long long': '<u8',
+    'int8': '<i1',
+    'uint8': '<u1',
+    'int16': '<i2',
+    'uint16': '<u2',
+    'int32': '<i4',
+    'uint32': '<u4',
+    'int64': '<i8',
+    'uint64': '<u8',
+}
+
+_serializer_cache = OrderedDict()
+_serializer_cache_lock = threading.Lock()
+
+
+def get_message_serializer(
+    message_class: Any, base64_encoding: bool = True, array_encoding: str = 'list'
+) -> Callable[[Any], OrderedDict]:
+    """
+    Return the compiled serializer for a ROS message class, compiling and caching it on first use.
+
+    :param message_class: The ROS message class to serialize.
+    :param base64_encoding: Encode `uint8[]` and `uint8[n]` fields using Base64, see `message_to_ordereddict`.
+    :param array_encoding: How to serialize arrays of numeric types, one of `ARRAY_ENCODINGS`.
+    :returns: A callable taking a message instance and returning an OrderedDict.
+    """
+    return _get_compiled(
+        ('serializer', message_class, base64_encoding, array_encoding),
+        lambda: compile_message_serializer(message_class, base64_encoding=base64_encoding, array_encoding=array_encoding),
+    )
+
+
+def get_message_deserializer(message_class: Any) -> Callable[..., None]:
+    """
+    Return the compiled deserializer for a ROS message class, compiling and caching it on first use.
+
+    :param message_class: The ROS message class to populate.
+    :returns: A callable with the signature of `set_message_fields`.
+    """
+    return _get_compiled(('deserializer', message_class), lambda: compile_message_deserializer(message_class))
+
+
+def _get_compiled(key, compile_function):
+    with _serializer_cache_lock:
+        compiled = _serializer_cache.get(key)
+        if compiled is not None:
+            _serializer_cache.move_to_end(key)
+            return compiled
+
+    compiled = compile_function()
+
+    with _serializer_cache_lock:
+        _serializer_cache[key] = compiled
+        while len(_serializer_cache) > SERIALIZER_CACHE_SIZE:
+            _serializer_cache.popitem(last=False)
+    return compiled
+
+
+def compile_message_serializer(
+    message_class: Any, *, base64_encoding: bool = True, array_encoding: str = 'list'
+) -> Callable[[Any], OrderedDict]:
+    """
+    Build a flat conversion plan for a ROS message class.
+
+    The field converters are resolved once from the rosidl type definitions in `SLOT_TYPES`, so converting a
+    message no longer walks the `isinstance` chain of `_convert_value` for every field. Arrays backed by
+    `array.array` or `numpy.ndarray` are converted in bulk. With the default `array_encoding` the result is
+    identical to `message_to_ordereddict(msg)` if `base64_encoding` is true, and to
+    `rosidl_runtime_py.convert.message_to_ordereddict(msg)` if it is false. The latter converts `byte` values
+    to strings of their characters and `uint8[]` fields to lists of integers.
+
+    :param message_class: The ROS message class to compile a serializer for.
+    :param base64_encoding: Encode `uint8[]` and `uint8[n]` fields using Base64, see `message_to_ordereddict`.
+    :param array_encoding: How to serialize arrays of numeric types, one of `ARRAY_ENCODINGS`.
+    :raises ValueError: If `array_encoding` is not supported.
+    :returns: A callable taking a message instance and returning an OrderedDict.
+    """
+    if array_encoding not in ARRAY_ENCODINGS:
+        raise ValueError('Unknown array encoding "%s".' % array_encoding)
+
+    plan = tuple(
+        (slot, slot[1:], _compile_field_converter(slot_type, base64_encoding, array_encoding))
+        for slot, slot_type in zip(message_class.__slots__, message_class.SLOT_TYPES)
+    )
+
+    def serialize(msg):
+        d = OrderedDict()
+        for slot, field_name, convert in plan:
+            d[field_name] = convert(getattr(msg, slot, None))
+        return d
+
+    return serialize
+
+
+def _compile_field_converter(field_type, base64_encoding, array_encoding):
+    if isinstance(field_type, NamespacedType):
+        return get_message_serializer(
+            import_message_from_namespaced_type(field_type), base64_encoding, array_encoding
+        )
+
+    convert_primitive = _convert_primitive if base64_encoding else _convert_rosidl_primitive
+
+    if isinstance(field_type, (BasicType, AbstractString, AbstractWString)):
+        return convert_primitive
+
+    if isinstance(field_type, AbstractNestedType):
+        value_type = field_type.value_type
+
+        def fallback(value):
+            if not base64_encoding:
+                return _convert_rosidl_value(value)
+            return _convert_value(value, base64_encoding=base64_encoding, field_type=field_type)
+
+        if (
+            base64_encoding
+            and isinstance(field_type, (Array, UnboundedSequence))
+            and type(value_type) is BasicType
+            and value_type.typename == 'uint8'
+        ):
+
+            def convert_uint8_array(value):
+                if type(value) not in _SEQUENCE_TYPES:
+                    return fallback(value)
+                return base64.b64encode(value).decode('utf-8')
+
+            return convert_uint8_array
+
+        if isinstance(value_type, NamespacedType):
+            element_serializer = get_message_serializer(
+                import_message_from_namespaced_type(value_type), base64_encoding, array_encoding
+            )
+
+            def convert_message_sequence(value):
+                if type(value) not in _SEQUENCE_TYPES:
+                    return fallback(value)
+                return [element_serializer(v) for v in value]
+
+            return convert_message_sequence
+
+        dtype = _NUMPY_DTYPES.get(value_type.typename) if type(value_type) is BasicType else None
+
+        if array_encoding == 'typed' and dtype is not None:
+
+            def convert_typed_array(value):
+                if type(value) not in _SEQUENCE_TYPES:
+                    return fallback(value)
+                # np.asarray reads array.array and ndarray buffers directly, without an intermediate list
+                data = np.asarray(value, dtype=dtype)
+                return OrderedDict(
+                    [('dtype', dtype), ('shape', list(data.shape)), ('data', base64.b64encode(data).decode('utf-8'))]
+                )
+
+            return convert_typed_array
+
+        def convert_primitive_sequence(value):
+            value_class = type(value)
+            if value_class in _BUFFER_TYPES:
+                # tolist() yields the same Python scalars as converting every item with _convert_value
+                return value.tolist()
+            if value_class is not list:
+                return fallback(value)
+            return [v if type(v) in _PRIMITIVE_TYPES else convert_primitive(v) for v in value]
+
+        return convert_primitive_sequence
+
+    def convert_unknown(value):
+        if not base64_encoding:
+            return _convert_rosidl_value(value)
+        return _convert_value(value, base64_encoding=base64_encoding, field_type=field_type)
+
+    return convert_unknown
+
+
+def compile_message_deserializer(message_class: Any) -> Callable[..., None]:
+    """
+    Build a flat plan that populates a ROS message class from a dictionary.
+
+    A setter is resolved once per field from a default constructed message and the rosidl type definitions,
+    nested messages and sequences of messages use the compiled plans of their own classes. Every element of a
+    sequence of messages gets a new message instance. Arrays are built in bulk from lists, Base64 strings or the
+    'typed' array encoding of the serializers, without converting buffers to lists.
+
+    :param message_class: The ROS message class to compile a deserializer for.
+    :returns: A callable with the signature of `set_message_fields`.
+    """
+    prototype = message_class()
+    setters = {
+        slot[1:]: _compile_field_setter(getattr(prototype, slot[1:]), slot_type)
+        for slot, slot_type in zip(message_class.__slots__, message_class.SLOT_TYPES)
+    }
+
+    def deserialize(msg, values, strict_mode=True, check_missing_fields=False):
+        if values is None:
+            values = {}
+        try:
+            items = values.items()
+        except AttributeError:
+            raise TypeError("Value '%s' is expected to be a dictionary but is a %s" % (values, type(values).__name__))
+
+        remaining_message_fields = set(setters) if check_missing_fields else None
+
+        for field_name, field_value in items:
+            if field_value is None:
+                continue
+            setter = setters.get(field_name)
+            if setter is None:
+                if strict_mode:
+                    raise AttributeError("'%s' object has no attribute '%s'" % (message_class.__name__, field_name))
+                continue
+            if remaining_message_fields is not None:
+                remaining_message_fields.discard(field_name)
+            setattr(msg, field_name, setter(field_value, strict_mode, check_missing_fields))
+
+        if remaining_message_fields:
+            error_message = 'fields in dictionary missing from ROS message: "{0}"'.format(
+                [field_name for field_name in setters if field_name in remaining_message_fields]
+            )
+            raise ValueError(error_message)
+
+    return deserialize
+
+
+def _compile_field_setter(default, field_type):
+    default_type = type(default)
+
+    if default_type is array.array:
+        typecode = default.typecode
+
+        def set_array(value, strict_mode, check_missing_fields):
+            if isinstance(value, (str, bytes)):
+                # If value is not properly base64 encoded and there are non-base64-alphabet characters in the
+                # input, a binascii.Error will be raised.
+                value = base64.b64decode(value, validate=True)
+                if typecode == 'B':
+                    # The decoded bytes are the buffer of a uint8 array
+                    return array.array(typecode, value)
+                # Every decoded byte is one element, widened in bulk. Casts that could change a value raise TypeError
+                return array.array(typecode, np.frombuffer(value, dtype=np.uint8).astype(typecode, casting='safe').tobytes())
+            elif isinstance(value, dict):
+                values = array.array(typecode)
+                values.frombytes(_decode_typed_array(value).astype(values.typecode, copy=False).tobytes())
+                return values
+            if type(value) is np.ndarray:
+                value = value.tolist()
+            return array.array(typecode, value)
+
+        return set_array
+
+    if default_type is np.ndarray:
+        dtype = default.dtype
+
+        def set_ndarray(value, strict_mode, check_missing_fields):
+            if isinstance(value, (str, bytes)):
+                # Every decoded byte is one element, like a list of the byte values
+                return np.frombuffer(base64.b64decode(value, validate=True), dtype=np.uint8).astype(dtype)
+            if isinstance(value, dict):
+                return _decode_typed_array(value).astype(dtype)
+            return np.array(value, dtype=dtype)
+
+        return set_ndarray
+
+    if isinstance(field_type, NamespacedType):
+        return _compile_message_setter(import_message_from_namespaced_type(field_type))
+
+    if isinstance(field_type, AbstractNestedType) and isinstance(field_type.value_type, NamespacedType):
+        set_element = _compile_message_setter(import_message_from_namespaced_type(field_type.value_type))
+
+        def set_message_sequence(value, strict_mode, check_missing_fields):
+            return [set_element(element, strict_mode, check_missing_fields) for element in value]
+
+        return set_message_sequence
+
+    def set_value(value, strict_mode, check_missing_fields):
+        if type(value) is default_type:
+            return value
+        return default_type(value)
+
+    return set_value
+
+
+def _decode_typed_array(value):
+    # Inverse of the 'typed' array encoding of the serializers
+    try:
+        dtype = np.dtype(value['dtype'])
+        data = base64.b64decode(value['data'], validate=True)
+    except KeyError as e:
+        raise TypeError('Typed array is missing %s' % e)
+    return np.frombuffer(data, dtype=dtype)
+
+
+def _compile_message_setter(message_class):
+    deserialize = get_message_deserializer(message_class)
+
+    def set_message(value, strict_mode, check_missing_fields):
+        if type(value) is message_class:
+            return value
+        msg = message_class()
+        deserialize(msg, value, strict_mode, check_missing_fields)
+        return msg
+
+    return set_message
+
+
+def _convert_primitive(value):
+    if type(value) in _PRIMITIVE_TYPES:
+        return value
+    return _convert_value(value)
+
+
+def _convert_rosidl_primitive(value):
+    if type(value) in _PRIMITIVE_TYPES:
+        return value
+    return _convert_rosidl_value(value)
+
+
+def _convert_rosidl_value(value):
+    # Same conversion as rosidl_runtime_py.convert._convert_value, which turns bytes into a string
+    # of their characters rather than an integer like _convert_value does
+    if isinstance(value, bytes):
+        return ''.join([chr(c) for c in value])
+    if isinstance(value, (list, tuple, array.array, np.ndarray)):
+        typename = tuple if isinstance(value, tuple) else list
+        return typename([_convert_rosidl_value(v) for v in value])
+    if isinstance(value, dict):
+        new_value = {} if type(value) is dict else OrderedDict()
+        for k, v in value.items():
+            new_value[_convert_rosidl_value(k)] = _convert_rosidl_value(v)
+        return new_value
+    if hasattr(value, 'get_fields_and_field_types'):
+        return get_message_serializer(type(value), base64_encoding=False)(value)
+    return _convert_value(value, base64_encoding=False)
+
+
 def __abbreviate_array_info(value, field_type):
     value_type_name = __get_type_name(field_type.value_type)
     if isinstance(field_type, rosidl_parser.definition.Array):
@@ -340,12 +654,6 @@ def __get_type_name(value_type):
         return 'unknown'
 
 
-def _get_message_fields(message):
-    # Workaround due to new python API https://github.com/ros2/rosidl_python/issues/99
-    slots = [slot[1:] for slot in message.__slots__]  # remove leading underscore
-    return zip(slots, message.SLOT_TYPES)
-
-
 if __name__ == "__main__":
     import doctest
 
@@ -5,6 +5,11 @@ import paho.mqtt.client as mqtt
 from paho.mqtt.properties import Properties
 from paho.mqtt.packettypes import PacketTypes
 from agent.logger import AirLogger
+from agent.batcher import AirBatcher
+from agent.compression import AirCompressor
+from agent.outbox import AirOutbox
+from agent.publish_queue import AirPublishQueue
+from agent.config import config_list
 from agent import MQTT_API_VERSION, AGENT_VERSION
 
 
@@ -23,17 +28,49 @@ class AirMqtt:
         'presence': 'presence',
         'cmd_confirm': 'commands/confirm',
         'container_confirm': 'containers/confirm',
+        'container_events': 'containers/events',
+        'container_status': 'containers/status',
         'logs_ingest': 'logs/ingest',
         'vitals_ingest': 'vitals/ingest',
         'data_ingest': 'data/ingest'
     }
 
+    # Priority class of each short topic in the publish queue
+    topic_priorities = {
+        'commands/confirm': 'control',
+        'containers/confirm': 'control',
+        'containers/events': 'events',
+        'containers/status': 'status',
+        'presence': 'presence',
+        'logs/ingest': 'logs',
+        'data/ingest': 'data',
+        'vitals/ingest': 'vitals'
+    }
+
 
     def __init__(self, config, on_msg) -> None:
     	
         self.config = config
         self.on_msg = on_msg
         self.logger = AirLogger(__name__, config).logger
+
+        # Short topics whose messages are grouped into batches before publishing
+        self.batch_topics = self.short_topics(config['batching']['topics'])
+        if self.bot_to_cloud_topics['logs_ingest'] in self.batch_topics:
+            # Logs are already sent as one array per window by the log aggregator
+            self.logger.error('logs_ingest cannot be batched, logs are batched by the logs window instead')
+            self.batch_topics.discard(self.bot_to_cloud_topics['logs_ingest'])
+        self.batcher = AirBatcher(config, self.publish) if self.batch_topics else None
+
+        # Short topics whose payloads are compressed, inbound payloads are decompressed on any topic
+        self.compress_topics = self.short_topics(config['compression']['topics'])
+        self.compressor = AirCompressor(config)
+
+        # Short topics that are stored on disk while disconnected and sent on reconnect
+        self.offline_topics = self.short_topics(config['offline']['topics'])
+        self.connected = False
+        self.publish_queue = AirPublishQueue(config, self.send_message, lambda: self.connected)
+        self.outbox = AirOutbox(config, self.publish_backlog) if self.offline_topics else None
         
         # config client
         mqtt_uname = f"{self.config['tenant_uuid']}-{self.config['robot_id']}"
@@ -59,6 +96,7 @@ class AirMqtt:
         self.mqtt_client.on_connect_fail = self.on_connect_fail
         self.mqtt_client.on_disconnect = self.on_disconnect
         self.mqtt_client.on_message = self.on_message
+        self.mqtt_client.on_publish = self.on_publish
         
         # Attempt connection
         try:
@@ -73,11 +111,15 @@ class AirMqtt:
   
     def on_connect(self, client, userdata, flags, rc, properties=None):
         self.logger.info("connected to mqtt broker")
+        self.connected = True
         
         for topic in self.cloud_to_bot_topics:
             self.mqtt_client.subscribe(f"{self.config['tenant_uuid']}/{self.config['robot_id']}/{topic}", 0)
         
         self.pub(self.bot_to_cloud_topics['presence'], self.presence_payload(True), 0)
+
+        if self.outbox:
+            self.outbox.drain()
         
 
     def on_connect_fail(self, client, userdata):
@@ -85,6 +127,8 @@ class AirMqtt:
 
 
     def on_disconnect(self, client, userdata, rc, properties=None):
+        self.connected = False
+        self.publish_queue.on_disconnected()
         self.logger.warning(f"disconnected from mqtt broker with rc: {mqtt.error_string(rc)}")
 
 
@@ -94,7 +138,9 @@ class AirMqtt:
         short_topic = '/'.join(msg.topic.split('/')[2:])
         data = None
         try:
-            data = json.loads(msg.payload.decode("utf-8"))
+            user_properties = getattr(msg.properties, 'UserProperty', []) if msg.properties else []
+            payload = self.compressor.decompress(msg.payload, user_properties)
+            data = json.loads(payload.decode("utf-8"))
         except:
             self.logger.exception("could not json load mqtt message")
             return
@@ -102,12 +148,77 @@ class AirMqtt:
         return self.on_msg(short_topic, data)
         
 
-    def pub(self, short_topic, payload, qos):
+    def on_publish(self, client, userdata, mid):
+        self.publish_queue.on_published(mid)
+
+
+    def pub(self, short_topic, payload, qos, user_properties=None, source=None):
+        '''
+        Publish a payload on a short topic. Payloads are JSON encoded unless they are already bytes,
+        extra user properties are sent next to air-mqtt-version. JSON payloads without extra user
+        properties on a batched topic are grouped into an array and flagged with air-batch. The source
+        identifies the producer for the keep_latest overflow policy of the publish queue.
+        '''
+        if isinstance(payload, (bytes, bytearray)):
+            self.publish(short_topic, payload, qos, user_properties, source)
+        else:
+            self.pub_json(short_topic, json.dumps(payload), qos, user_properties, source)
+
+
+    def pub_json(self, short_topic, data: str, qos, user_properties=None, source=None):
+        '''
+        Publish a payload that is already JSON encoded
+        '''
+        if short_topic in self.batch_topics and not user_properties:
+            self.batcher.add(short_topic, data, qos)
+        else:
+            self.publish(short_topic, data, qos, user_properties, source)
+
+
+    def publish(self, short_topic, data, qos, user_properties=None, source=None):
+        if short_topic in self.compress_topics:
+            data, encoding_properties = self.compressor.compress(data)
+            user_properties = (user_properties or []) + encoding_properties
+
+        if not self.connected and short_topic in self.offline_topics:
+            self.outbox.put(short_topic, data, qos, user_properties)
+            self.logger.debug(f'stored message on {short_topic} while disconnected')
+            return
+
+        priority = self.topic_priorities.get(short_topic, 'control')
+        self.publish_queue.put(priority, short_topic, data, qos, user_properties, source)
+
+
+    def publish_backlog(self, short_topic, data, qos, user_properties, on_sent) -> bool:
+        # Messages from the outbox are already compressed and go behind all live traffic
+        return self.publish_queue.put('backlog', short_topic, data, qos, user_properties, on_sent=on_sent)
+
+
+    def send_message(self, short_topic, data, qos, user_properties=None):
         topic = f"{self.config['tenant_uuid']}/{self.config['robot_id']}/{short_topic}"
-        self.mqtt_client.publish(topic, json.dumps(payload), qos, properties=self.properties)
+        info = self.mqtt_client.publish(topic, data, qos, properties=self.publish_properties(user_properties))
         self.logger.debug(f'published message on {short_topic}')
+        return info
+
+
+    def publish_properties(self, user_properties=None):
+        if not user_properties:
+            return self.properties
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.UserProperty = self.properties.UserProperty + list(user_properties)
+        return properties
 
     
+    def short_topics(self, keys):
+        short_topics = set()
+        for key in config_list(keys):
+            if key in self.bot_to_cloud_topics:
+                short_topics.add(self.bot_to_cloud_topics[key])
+            else:
+                self.logger.error(f'unknown topic {key} in config')
+        return short_topics
+
+
     def presence_payload(self, online: bool):
         return { 
             'online': online,
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from agent import AIR_PATH
+from agent.logger import AirLogger
+
+
+class AirOutbox:
+    """
+    Persistent store-and-forward queue for messages published while the broker is unreachable.
+
+    Messages are appended to an SQLite database in WAL mode under AIR_PATH. Disk usage is
+    bounded by max_bytes, once exceeded the oldest messages are evicted first. On reconnect
+    the queue is drained oldest first at drain_rate messages per second into the lowest
+    priority class of the publish queue, and a message is deleted once the broker
+    acknowledged it.
+    """
+
+    DB_PATH = os.path.join(AIR_PATH, 'outbox.db')
+    EVICT_BATCH = 100
+
+    def __init__(self, config, enqueue) -> None:
+        self.logger = AirLogger(__name__, config).logger
+        self.enqueue = enqueue
+        self.max_bytes = int(config['offline']['max_bytes'])
+        self.drain_rate = float(config['offline']['drain_rate'])
+        self.lock = threading.Lock()
+        self.draining = False
+        self.pending = set()
+
+        self.db = sqlite3.connect(self.DB_PATH, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            qos INTEGER NOT NULL,
+            properties TEXT NOT NULL,
+            size INTEGER NOT NULL
+        )''')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM messages').fetchone()[0]
+
+
+    def put(self, short_topic, data, qos, user_properties=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        properties = json.dumps(user_properties or [])
+        size = len(data) + len(properties) + len(short_topic)
+
+        with self.lock:
+            cursor = self.db.execute('INSERT INTO messages (topic, payload, qos, properties, size) VALUES (?, ?, ?, ?, ?)',
+                                     (short_topic, data, qos, properties, size))
+            self.size += size
+            evicted = self.evict(cursor.lastrowid)
+            self.db.commit()
+
+        if evicted:
+            self.logger.warning(f'outbox full, evicted {evicted} oldest messages')
+
+
+    def evict(self, keep_id):
+        '''
+        Delete the oldest messages until the outbox fits in max_bytes again, never the message
+        with keep_id which was just added. Returns the number of deleted messages.
+        '''
+        freed = 0
+        evicted = 0
+        last_id = 0
+
+        while self.size - freed > self.max_bytes:
+            rows = self.db.execute('SELECT id, size FROM messages WHERE id > ? AND id != ? ORDER BY id LIMIT ?',
+                                   (last_id, keep_id, self.EVICT_BATCH)).fetchall()
+            if not rows:
+                break
+            for row_id, row_size in rows:
+                last_id = row_id
+                freed += row_size
+                evicted += 1
+                if self.size - freed <= self.max_bytes:
+                    break
+
+        if evicted:
+            self.db.execute('DELETE FROM messages WHERE id <= ? AND id != ?', (last_id, keep_id))
+            self.size -= freed
+        return evicted
+
+
+    def drain(self):
+        '''
+        Starts draining the queue in the background, called when the broker connection is up
+        '''
+        with self.lock:
+            if self.draining:
+                return
+            self.draining = True
+
+        drain_thread = threading.Thread(target=self.drain_messages, daemon=True)
+        drain_thread.start()
+
+
+    def drain_messages(self):
+        queued = 0
+        last_id = 0
+        try:
+            while True:
+                started = time.monotonic()
+                batch_size = max(1, int(self.drain_rate))
+
+                with self.lock:
+                    rows = self.db.execute('SELECT id, topic, payload, qos, properties, size FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+                                           (last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+
+                for row_id, topic, payload, qos, properties, size in rows:
+                    last_id = row_id
+                    with self.lock:
+                        if row_id in self.pending:
+                            continue
+                        self.pending.add(row_id)
+
+                    on_sent = lambda delivered, row_id=row_id, size=size: self.on_sent(row_id, size, delivered)
+                    if not self.enqueue(topic, payload, qos, [tuple(prop) for prop in json.loads(properties)], on_sent):
+                        # The backlog class of the publish queue is full, retry from this message
+                        with self.lock:
+                            self.pending.discard(row_id)
+                        last_id = row_id - 1
+                        break
+                    queued += 1
+
+                # Spread each batch over a second to keep to the drain rate
+                time.sleep(max(0, len(rows) / self.drain_rate - (time.monotonic() - started)))
+
+            if queued:
+                self.logger.info(f'queued {queued} messages from outbox')
+        except:
+            self.logger.exception('failed to drain outbox')
+        finally:
+            with self.lock:
+                self.draining = False
+
+
+    def on_sent(self, row_id, size, delivered):
+        # Rows are only deleted once the broker acknowledged them, otherwise the next drain sends them again
+        with self.lock:
+            self.pending.discard(row_id)
+            if delivered:
+                cursor = self.db.execute('DELETE FROM messages WHERE id = ?', (row_id,))
+                self.db.commit()
+                if cursor.rowcount:
+                    self.size -= size
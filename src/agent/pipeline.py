@@ -0,0 +1,98 @@
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from agent.logger import AirLogger
+
+
+class AirPipeline:
+    """
+    Moves message encoding and publishing off the ROS executor thread.
+
+    Callbacks submit an encode function with its arguments and a publish function for the
+    result. Jobs run on a pool of worker threads, jobs with the same key always go to the
+    same worker so they are published in order. In process mode the encode step of jobs
+    submitted with process=True runs in a worker process, which requires the function and
+    its arguments to be picklable. Queue depth, drops and the average latency of every
+    stage are reported by stats().
+    """
+
+    MODES = ('thread', 'process')
+
+    # Weight of the latest sample in the exponential moving average of the stage latencies
+    LATENCY_ALPHA = 0.1
+
+    def __init__(self, config) -> None:
+        self.logger = AirLogger(__name__, config).logger
+        self.workers = max(1, int(config['pipeline']['workers']))
+        self.max_depth = int(config['pipeline']['max_depth'])
+        self.mode = config['pipeline']['mode']
+        if self.mode not in self.MODES:
+            self.logger.error(f'unknown pipeline mode {self.mode}, using thread')
+            self.mode = 'thread'
+
+        # Workers are started from a fork server rather than forked from the agent, whose threads may
+        # hold locks or ROS state at that moment. The pool is created before any thread is started
+        self.process_pool = None
+        if self.mode == 'process':
+            self.process_pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('forkserver'))
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.dropped = 0
+        self.latency = { 'queue': 0.0, 'encode': 0.0, 'publish': 0.0 }
+        self.queues = []
+
+        for _ in range(self.workers):
+            jobs = queue.Queue()
+            self.queues.append(jobs)
+            worker_thread = threading.Thread(target=self.run, args=(jobs,), daemon=True)
+            worker_thread.start()
+
+
+    def submit(self, key, encode, args, publish, process=False) -> bool:
+        with self.lock:
+            if self.depth >= self.max_depth:
+                self.dropped += 1
+                return False
+            self.depth += 1
+
+        self.queues[hash(key) % self.workers].put((time.monotonic(), encode, args, publish, process))
+        return True
+
+
+    def run(self, jobs):
+        while True:
+            submitted, encode, args, publish, process = jobs.get()
+            started = time.monotonic()
+
+            try:
+                if process and self.process_pool:
+                    result = self.process_pool.submit(encode, *args).result()
+                else:
+                    result = encode(*args)
+                encoded = time.monotonic()
+
+                publish(result)
+                published = time.monotonic()
+                self.record(started - submitted, encoded - started, published - encoded)
+            except:
+                self.logger.exception('pipeline job failed')
+            finally:
+                with self.lock:
+                    self.depth -= 1
+
+
+    def record(self, queued, encoded, published):
+        with self.lock:
+            for stage, duration in (('queue', queued), ('encode', encoded), ('publish', published)):
+                self.latency[stage] += self.LATENCY_ALPHA * (duration - self.latency[stage])
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': self.depth,
+                'dropped': self.dropped,
+                'latency_ms': { stage: round(value * 1000, 3) for stage, value in self.latency.items() }
+            }
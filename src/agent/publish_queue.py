@@ -0,0 +1,187 @@
+import time
+import threading
+from collections import deque
+import paho.mqtt.client as mqtt
+from agent.logger import AirLogger
+
+
+class AirPublishQueue:
+    """
+    Bounded priority queue in front of the MQTT client.
+
+    Every message belongs to a priority class, classes are sent strictly in PRIORITIES order.
+    At most max_inflight messages are handed to the MQTT client until they are acknowledged,
+    so a burst of low priority messages cannot delay a confirm behind it. A message can carry
+    an on_sent callback, called with True once the broker acknowledged it or with False when
+    it was dropped or failed. When a class is full its overflow policy applies:
+        drop_oldest:  drop the oldest queued message of the class
+        drop_newest:  drop the message being added
+        keep_latest:  replace a queued message from the same source, otherwise drop the oldest
+    """
+
+    PRIORITIES = ('control', 'presence', 'events', 'status', 'logs', 'data', 'vitals', 'backlog')
+    POLICIES = ('drop_oldest', 'drop_newest', 'keep_latest')
+
+    # Inflight messages not acknowledged within this many seconds stop counting towards max_inflight
+    INFLIGHT_TIMEOUT = 30
+
+    def __init__(self, config, send, is_connected) -> None:
+        self.logger = AirLogger(__name__, config).logger
+        self.send = send
+        self.is_connected = is_connected
+        self.max_inflight = int(config['publish_queue']['max_inflight'])
+        self.condition = threading.Condition()
+        self.inflight = {}
+        self.acked_early = set()
+        self.on_sent_callbacks = {}
+        self.classes = {}
+
+        for name in self.PRIORITIES:
+            policy = config['publish_queue'][f'{name}_policy']
+            if policy not in self.POLICIES:
+                self.logger.error(f'unknown overflow policy {policy} for {name}, using drop_oldest')
+                policy = 'drop_oldest'
+            self.classes[name] = {
+                'queue': deque(),
+                'capacity': int(config['publish_queue'][f'{name}_capacity']),
+                'policy': policy,
+                'latest': {},
+                'dropped': 0
+            }
+
+        sender_thread = threading.Thread(target=self.run, daemon=True)
+        sender_thread.start()
+
+
+    def put(self, priority, short_topic, data, qos, user_properties=None, source=None, on_sent=None) -> bool:
+        dropped = None
+
+        with self.condition:
+            queue_class = self.classes[priority]
+            queue = queue_class['queue']
+            key = (short_topic, source)
+            conflate = queue_class['policy'] == 'keep_latest' and source is not None
+
+            if conflate and key in queue_class['latest']:
+                queue_class['latest'][key][1:4] = [data, qos, user_properties]
+                queue_class['dropped'] += 1
+                return True
+
+            if len(queue) >= queue_class['capacity']:
+                queue_class['dropped'] += 1
+                if queue_class['policy'] == 'drop_newest':
+                    return False
+                dropped = queue.popleft()
+                self.forget(queue_class, dropped)
+
+            entry = [short_topic, data, qos, user_properties, source, on_sent]
+            queue.append(entry)
+            if conflate:
+                queue_class['latest'][key] = entry
+            self.condition.notify()
+
+        if dropped is not None:
+            self.notify_sent(dropped[5], False)
+        return True
+
+
+    def forget(self, queue_class, entry):
+        key = (entry[0], entry[4])
+        if queue_class['latest'].get(key) is entry:
+            del queue_class['latest'][key]
+
+
+    def notify_sent(self, on_sent, delivered):
+        if on_sent is None:
+            return
+        try:
+            on_sent(delivered)
+        except:
+            self.logger.exception('on_sent callback failed')
+
+
+    def on_published(self, mid):
+        with self.condition:
+            if self.inflight.pop(mid, None) is None and mid not in self.on_sent_callbacks:
+                # The broker acknowledged before the sender recorded the mid
+                self.acked_early.add(mid)
+                if len(self.acked_early) > self.max_inflight * 10:
+                    self.acked_early.clear()
+            on_sent = self.on_sent_callbacks.pop(mid, None)
+            self.condition.notify()
+
+        self.notify_sent(on_sent, True)
+
+
+    def on_disconnected(self):
+        # Queued messages are kept for the next connection, paho retransmits the inflight ones itself
+        # and their on_sent callbacks stay registered until they are acknowledged
+        with self.condition:
+            self.inflight.clear()
+            self.acked_early.clear()
+            self.condition.notify()
+
+
+    def next_entry(self):
+        now = time.monotonic()
+        for mid, sent_at in list(self.inflight.items()):
+            if now - sent_at > self.INFLIGHT_TIMEOUT:
+                del self.inflight[mid]
+
+        if len(self.inflight) >= self.max_inflight or not self.is_connected():
+            return None
+
+        for name in self.PRIORITIES:
+            queue_class = self.classes[name]
+            if queue_class['queue']:
+                entry = queue_class['queue'].popleft()
+                self.forget(queue_class, entry)
+                return entry
+        return None
+
+
+    def run(self):
+        while True:
+            with self.condition:
+                entry = self.next_entry()
+                while entry is None:
+                    # Wake up periodically to expire inflight messages and notice reconnects
+                    self.condition.wait(1)
+                    entry = self.next_entry()
+
+            short_topic, data, qos, user_properties, source, on_sent = entry
+            try:
+                info = self.send(short_topic, data, qos, user_properties)
+            except:
+                self.logger.exception(f'failed to publish message on {short_topic}')
+                self.notify_sent(on_sent, False)
+                continue
+
+            # Without a connection paho still stores QoS 1 and 2 messages and sends them after reconnecting
+            retained = info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0
+            if info.rc != mqtt.MQTT_ERR_SUCCESS and not retained:
+                self.logger.warning(f'failed to publish message on {short_topic}: {mqtt.error_string(info.rc)}')
+                self.notify_sent(on_sent, False)
+                continue
+
+            with self.condition:
+                acked = info.mid in self.acked_early
+                if acked:
+                    self.acked_early.discard(info.mid)
+                else:
+                    if not retained:
+                        self.inflight[info.mid] = time.monotonic()
+                    if on_sent is not None:
+                        self.on_sent_callbacks[info.mid] = on_sent
+
+            if acked:
+                self.notify_sent(on_sent, True)
+
+
+    def stats(self):
+        with self.condition:
+            return {
+                'inflight': len(self.inflight),
+                'queued': { name: len(queue_class['queue']) for name, queue_class in self.classes.items() },
+                'dropped': { name: queue_class['dropped'] for name, queue_class in self.classes.items() }
+            }
@@ -0,0 +1,112 @@
+import os
+import time
+import psutil
+from agent.logger import AirLogger
+
+
+class AirResources:
+    """
+    Accounts CPU and memory usage to ROS node processes and compose managed containers.
+
+    Processes started with --ros-args are found by scanning the process table every
+    scan_period seconds, their psutil.Process handles are kept so every sample only reads
+    the CPU times of the known nodes. Container CPU usage is computed from the difference of
+    the CPU counters of two docker stats calls. Both report the top_n consumers.
+    """
+
+    def __init__(self, config, docker_client=None) -> None:
+        self.logger = AirLogger(__name__, config).logger
+        self.docker_client = docker_client
+        self.top_n = int(config['vitals']['top_n'])
+        self.scan_period = float(config['vitals']['process_scan_period'])
+        self.next_scan = 0
+        self.processes = {}
+        self.container_counters = {}
+
+
+    def scan_processes(self):
+        for pid, entry in list(self.processes.items()):
+            if not entry['process'].is_running():
+                del self.processes[pid]
+
+        for process in psutil.process_iter(['cmdline']):
+            if process.pid in self.processes or process.pid == os.getpid():
+                continue
+            name = self.node_name(process.info['cmdline'] or [])
+            if name:
+                self.processes[process.pid] = { 'process': process, 'name': name, 'cpu_time': None, 'sampled_at': None }
+
+
+    def node_name(self, cmdline):
+        if '--ros-args' not in cmdline:
+            return None
+
+        # The node name is remapped with __node:=<name>, otherwise use the executable
+        for arg in cmdline:
+            if arg.startswith('__node:=') or arg.startswith('__name:='):
+                return arg.split(':=', 1)[1]
+        executable = cmdline[1] if os.path.basename(cmdline[0]).startswith('python') and len(cmdline) > 1 else cmdline[0]
+        return os.path.basename(executable)
+
+
+    def collect_processes(self):
+        now = time.monotonic()
+        if now >= self.next_scan:
+            self.scan_processes()
+            self.next_scan = now + self.scan_period
+
+        usage = []
+        for pid, entry in list(self.processes.items()):
+            try:
+                with entry['process'].oneshot():
+                    cpu_times = entry['process'].cpu_times()
+                    rss = entry['process'].memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                del self.processes[pid]
+                continue
+
+            cpu_time = cpu_times.user + cpu_times.system
+            if entry['cpu_time'] is not None and now > entry['sampled_at']:
+                usage.append({
+                    'name': entry['name'],
+                    'pid': pid,
+                    'cpu': round((cpu_time - entry['cpu_time']) / (now - entry['sampled_at']) * 100, 1),
+                    'ram_mb': round(rss / 2**20, 1)
+                })
+            entry['cpu_time'] = cpu_time
+            entry['sampled_at'] = now
+
+        return { 'processes': self.top(usage) }
+
+
+    def collect_containers(self):
+        if self.docker_client is None:
+            return {}
+
+        usage = []
+        counters = {}
+        for container in self.docker_client.containers.list(filters={ 'label': 'com.docker.compose.project' }):
+            stats = container.stats(stream=False)
+            cpu_stats = stats.get('cpu_stats', {})
+            total = cpu_stats.get('cpu_usage', {}).get('total_usage')
+            system = cpu_stats.get('system_cpu_usage')
+            if total is None or system is None:
+                continue
+            counters[container.id] = (total, system)
+
+            previous = self.container_counters.get(container.id)
+            if previous is None or system <= previous[1]:
+                continue
+            online_cpus = cpu_stats.get('online_cpus') or 1
+            usage.append({
+                'name': container.name,
+                'cpu': round((total - previous[0]) / (system - previous[1]) * online_cpus * 100, 1),
+                'ram_mb': round(stats.get('memory_stats', {}).get('usage', 0) / 2**20, 1)
+            })
+
+        self.container_counters = counters
+        return { 'containers': self.top(usage) }
+
+
+    def top(self, usage):
+        return sorted(usage, key=lambda entry: entry['cpu'], reverse=True)[:self.top_n]
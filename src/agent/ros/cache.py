@@ -0,0 +1,96 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class AirEntityCache:
+    """
+    Keyed LRU cache of ROS entities such as publishers, service clients and action clients.
+
+    Reusing an entity skips DDS discovery, so commands sent in quick succession are not lost
+    while a fresh endpoint is matched. Entities are destroyed once they have not been used for
+    idle_timeout seconds or when the cache holds more than max_size of them, least recently
+    used first. Entities acquired for an outstanding request are never evicted.
+
+    Entities are created outside of the cache lock, so waiting for discovery of one entity does
+    not block lookups of the others. Concurrent lookups of a key being created wait for it.
+    """
+
+    def __init__(self, max_size, idle_timeout) -> None:
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key, create, destroy):
+        with self.lock:
+            entry = self.entries.get(key)
+            creating = entry is None
+            if creating:
+                entry = { 'entity': None, 'error': None, 'ready': threading.Event(), 'destroy': destroy, 'in_use': 0 }
+                self.entries[key] = entry
+            else:
+                self.entries.move_to_end(key)
+            entry['last_used'] = time.monotonic()
+
+        if not creating:
+            entry['ready'].wait()
+            if entry['error'] is not None:
+                raise RuntimeError(f'creating {key} failed: {entry["error"]}')
+            return entry['entity']
+
+        try:
+            entry['entity'] = create()
+        except Exception as e:
+            entry['error'] = e
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+            raise
+        finally:
+            entry['ready'].set()
+
+        with self.lock:
+            evicted = self.evictable(time.monotonic(), keep=key)
+        self.destroy(evicted)
+        return entry['entity']
+
+
+    def acquire(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries[key]['in_use'] += 1
+
+
+    def release(self, key):
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries[key]
+                entry['in_use'] = max(0, entry['in_use'] - 1)
+                entry['last_used'] = time.monotonic()
+
+
+    def sweep(self):
+        with self.lock:
+            evicted = self.evictable(time.monotonic())
+        self.destroy(evicted)
+
+
+    def evictable(self, now, keep=None):
+        evicted = []
+        excess = len(self.entries) - self.max_size
+
+        for key, entry in list(self.entries.items()):
+            if entry['in_use'] or key == keep or not entry['ready'].is_set():
+                continue
+            if excess > 0 or now - entry['last_used'] > self.idle_timeout:
+                evicted.append(self.entries.pop(key))
+                excess -= 1
+
+        return evicted
+
+
+    def destroy(self, evicted):
+        for entry in evicted:
+            entry['destroy'](entry['entity'])
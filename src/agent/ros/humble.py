@@ -3,12 +3,19 @@ from typing import Callable, List, Dict
 import rclpy
 from rclpy.node import Node
 from rclpy.action import ActionClient
+from rclpy.clock import Clock, ClockType
+from rclpy.executors import MultiThreadedExecutor
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup, ReentrantCallbackGroup
+from rclpy.serialization import deserialize_message
 from rcl_interfaces.msg import Log
-import importlib
 import sys
 import distro
 from agent.ros import SUPPORTED_DISTRO_ID, SUPPORTED_DISTRO_VER
+from agent.ros.cache import AirEntityCache
+from agent.ros.registry import AirTypeRegistry
+import time
 from agent import message_converter
+from jsonschema import ValidationError
 
 
 class AgentNode(Node):
@@ -20,25 +27,36 @@ class AgentNode(Node):
 
 class AirRosHumble:
 
-    primitives = ('bool', 'byte', 'char', 'float32', 'float64', 'float',
-              'int', 'int8', 'uint8', 'int16', 'uint16', 'int32', 'double',
-              'uint32', 'int64', 'uint64', 'string', 'wstring')
-    
-    float_types = ('float32', 'float64', 'float', 'double')
-    
-
     def __init__(self, config, on_log):
         self.logger = AirLogger(__name__, config).logger
         self.check_distro()
         self.on_log = on_log
+        self.log_filter = None
         rclpy.init(args=None)
         self.node = AgentNode()
-        self.rosout_sub = self.node.create_subscription(Log, '/rosout', self.log_callback, 1)
+
+        # Logs, every data stream and command handling get their own callback groups so the
+        # multi threaded executor can run them in parallel and a slow stream cannot starve the others
+        self.executor = MultiThreadedExecutor(num_threads=int(config['ros']['executor_threads']))
+        self.logs_group = MutuallyExclusiveCallbackGroup()
+        self.commands_group = ReentrantCallbackGroup()
+        self.data_groups = {}
+
+        self.rosout_sub = self.node.create_subscription(Log, '/rosout', self.log_callback, int(config['logs']['queue_depth']),
+                                                        callback_group=self.logs_group)
         self.data_subscriptions = []
+        self.data_timers = []
+        self.registry = AirTypeRegistry(self.logger)
+
+        # Publishers and clients used by commands are kept warm and reused
+        self.discovery_timeout = float(config['ros']['discovery_timeout'])
+        self.entities = AirEntityCache(int(config['ros']['entity_cache_size']), float(config['ros']['entity_idle_timeout']))
+        self.entities_timer = self.node.create_timer(self.entities.idle_timeout / 2, self.entities.sweep,
+                                                     callback_group=self.commands_group)
 
 
     def spin(self):
-        rclpy.spin(self.node)
+        rclpy.spin(self.node, executor=self.executor)
 
 
     def check_distro(self):
@@ -50,19 +68,30 @@ class AirRosHumble:
 
     # LOGS
     def log_callback(self, msg):
-        self.on_log(msg)
+        # Filter before anything is built from the message
+        log_filter = self.log_filter
+        if log_filter is None or log_filter.matches(msg):
+            self.on_log(msg)
+
+
+    def set_log_filter(self, log_filter):
+        self.log_filter = log_filter
 
     
     # DATA
-    def subscribe(self, topic, msg_type, callback):
+    def subscribe(self, topic, msg_type, callback, raw=False):
+        '''
+        Subscribe to a topic and return the message class, or None if the subscription failed.
+        When raw is set the callback receives the serialized CDR bytes, which can be passed
+        to deserialize() only for the samples that are actually used.
+        '''
 
         try:
-            mod_name = msg_type.split('/')[0]
-            class_name = msg_type.split('/')[2]
-            mod = importlib.import_module(mod_name + '.msg')
-            msg_class = getattr(mod, class_name)
-            sub = self.node.create_subscription(msg_class, topic, callback, 1)
+            msg_class = self.registry.resolve(msg_type, 'msg')
+            self.data_groups[topic] = MutuallyExclusiveCallbackGroup()
+            sub = self.node.create_subscription(msg_class, topic, callback, 1, raw=raw, callback_group=self.data_groups[topic])
             self.data_subscriptions.append(sub)
+            return msg_class
 
         except ImportError as e:
             self.logger.error(e)
@@ -77,17 +106,47 @@ class AirRosHumble:
             self.logger.exception(f'topic subscription failed for: {topic}')
     
 
+    @staticmethod
+    def deserialize(data, msg_class):
+        return deserialize_message(data, msg_class)
+
+
+    def type_hash(self, msg_class):
+        return self.registry.type_hash(msg_class)
+
+
+    def prewarm_types(self, type_names):
+        self.registry.prewarm(type_names)
+
+
+    def create_data_timer(self, topic, period, callback):
+        # Use the steady clock so sampling is unaffected by wall clock jumps and sim time,
+        # and the group of the topic so the timer never runs concurrently with its subscription
+        timer = self.node.create_timer(period, callback, callback_group=self.data_groups[topic],
+                                       clock=Clock(clock_type=ClockType.STEADY_TIME))
+        self.data_timers.append(timer)
+        return timer
+
+
     def clear_data_subscriptions(self):
         for sub in self.data_subscriptions:
             self.node.destroy_subscription(sub)
+        for timer in self.data_timers:
+            self.node.destroy_timer(timer)
         self.data_subscriptions = []
+        self.data_timers = []
+        self.data_groups = {}
     
     # TOPICS
     def pub_topic(self, topic:str, msg_type:str, msg_args:dict) -> dict:
      
         try:
-            msg = message_converter.convert_dictionary_to_ros_message(msg_type, msg_args)
-            publisher = self.node.create_publisher(msg.__class__, topic, 10)
+            msg_class = self.registry.resolve(msg_type, 'msg')
+            self.registry.payload_validator(msg_class).validate(msg_args)
+            msg = message_converter.convert_dictionary_to_ros_message(msg_class, msg_args)
+            publisher = self.entities.get(('publisher', topic, msg.__class__, 10),
+                                          lambda: self.create_publisher(msg.__class__, topic, 10),
+                                          self.node.destroy_publisher)
             publisher.publish(msg)
             self.logger.info(f'published to ROS topic: {topic}')
             return { 'success': True, 'error_code': None }
@@ -104,6 +163,14 @@ class AirRosHumble:
             self.logger.error(e)
             return { 'success': False, 'error_code': 'invalid_payload' }
 
+        except ValidationError as e:
+            self.logger.error(f'invalid payload: {e.message}')
+            return { 'success': False, 'error_code': 'invalid_payload' }
+
+        except (ValueError, TypeError) as e:
+            self.logger.error(e)
+            return { 'success': False, 'error_code': 'invalid_payload' }
+
         except:
             self.logger.exception(f'call topic failed: {topic}')
             return { 'success': False, 'error_code': 'unknown_error' }
@@ -113,18 +180,17 @@ class AirRosHumble:
     def call_service(self, srv_name:str, srv_type:str, srv_args:dict) -> dict:
     
         try:
-            mod_name = srv_type.split('/')[0]
-            class_name = srv_type.split('/')[2]
-            mod = importlib.import_module(mod_name + '.srv')
-            srv_class = getattr(mod, class_name)
-
-            srv_req = message_converter.convert_dictionary_to_ros_message(srv_type, srv_args, kind='request')
+            srv_class = self.registry.resolve(srv_type, 'srv')
+            self.registry.payload_validator(srv_class.Request).validate(srv_args)
+            srv_req = message_converter.convert_dictionary_to_ros_message(srv_class.Request, srv_args)
    
-            client = self.node.create_client(srv_class, srv_name)
+            key = ('client', srv_name, srv_class)
+            client = self.entities.get(key, lambda: self.create_client(srv_class, srv_name), self.node.destroy_client)
     
             if client.service_is_ready():
+                self.entities.acquire(key)
                 future = client.call_async(srv_req)
-                future.add_done_callback(self.service_callback)
+                future.add_done_callback(lambda future, key=key: self.service_callback(future, key))
                 self.logger.info(f'called service {srv_name}')
                 return { 'success': True, 'error_code': None }
             
@@ -145,13 +211,22 @@ class AirRosHumble:
             self.logger.error(e)
             return { 'success': False, 'error_code': 'invalid_payload' }
 
+        except ValidationError as e:
+            self.logger.error(f'invalid payload: {e.message}')
+            return { 'success': False, 'error_code': 'invalid_payload' }
+
+        except (ValueError, TypeError) as e:
+            self.logger.error(e)
+            return { 'success': False, 'error_code': 'invalid_payload' }
+
         except:
             self.logger.exception(f'call service failed: {srv_name}')
             return { 'success': False, 'error_code': 'unknown_error' }
 
 
 
-    def service_callback(self, future):
+    def service_callback(self, future, key):
+        self.entities.release(key)
         try:
             result = future.result()
             self.logger.info('service call succeeded')
@@ -162,23 +237,20 @@ class AirRosHumble:
     # ACTIONS
     def action_send_goal(self, act_name:str, act_type:str, act_args:dict):
         try:
-
-            mod_name = act_type.split('/')[0]
-            class_name = act_type.split('/')[2]
-
-            # dynamically import module service module depending on payload
-            mod = importlib.import_module(mod_name + '.action')
-            action_class = getattr(mod, class_name)
-            client = ActionClient(self.node, action_class, act_name)
-
-            goal_msg = action_class.Goal()
-            
-            # Use the helper to populate the Goal with values from json
-            self.derserialize_json(goal_msg, 'action', act_args)
+            action_class = self.registry.resolve(act_type, 'action')
+            key = ('action', act_name, action_class)
+            client = self.entities.get(key, lambda: self.create_action_client(action_class, act_name),
+                                       lambda client: client.destroy())
+
+            self.registry.payload_validator(action_class.Goal).validate(act_args)
+            # Goals must set every field, nested messages and sequences are built from the cached plan of the type
+            goal_msg = message_converter.convert_dictionary_to_ros_message(action_class.Goal, act_args, check_missing_fields=True)
             
             if client.server_is_ready():
+                # Keep the client cached until the goal is rejected or finished
+                self.entities.acquire(key)
                 server_res_future = client.send_goal_async(goal_msg, self.action_feedback_callback)
-                server_res_future.add_done_callback(self.action_response_callback)
+                server_res_future.add_done_callback(lambda server_res, key=key: self.action_response_callback(server_res, key))
                 self.logger.info('sent goal to action server')
                 return { 'success': True, 'error_code': None }
             else:
@@ -197,20 +269,35 @@ class AirRosHumble:
             self.logger.error(e)
             return { 'success': False, 'error_code': 'invalid_payload' }
 
+        except ValidationError as e:
+            self.logger.error(f'invalid payload: {e.message}')
+            return { 'success': False, 'error_code': 'invalid_payload' }
+
+        except (ValueError, TypeError) as e:
+            self.logger.error(e)
+            return { 'success': False, 'error_code': 'invalid_payload' }
+
         except:
             self.logger.exception(f'action send goal failed: {act_name}')
             return { 'success': False, 'error_code': 'unknown_error' }
     
     
-    def action_response_callback(self, server_res):
+    def action_response_callback(self, server_res, key):
         self.logger.debug('action response callback')
-        result = server_res.result()
+        try:
+            result = server_res.result()
+        except:
+            self.entities.release(key)
+            self.logger.exception('action send goal failed')
+            return
+
         if result.accepted == True:
             self.logger.debug('action server accepted the request')
             action_res_future = result.get_result_async()
-            action_res_future.add_done_callback(self.action_result_callback)
+            action_res_future.add_done_callback(lambda future, key=key: self.action_result_callback(future, key))
             # NOTE potentially send mqtt feedback
         else:
+            self.entities.release(key)
             self.logger.debug('action server did not accept')
             # NOTE potentially send mqtt feedback
 
@@ -219,53 +306,28 @@ class AirRosHumble:
         self.logger.debug('action feedback callback')
         
 
-    def action_result_callback(self, future):
+    def action_result_callback(self, future, key):
+        self.entities.release(key)
         self.logger.debug('action result callback')
 
-    
 
-    # HELPERS
-    def derserialize_json(self, ros_obj, ros_inter, json_args):
-        '''
-        Given a ROS Msg type and a corresponding json_args, this function will populate
-        the RosMsg fields with the json_args. It will recursively call itself when it 
-        encouters a RosMsg field that is not a primitive.
-        '''
+    # ENTITIES
+    def create_publisher(self, msg_class, topic, depth):
+        # Give discovery a chance to match subscribers so the first message is not lost
+        publisher = self.node.create_publisher(msg_class, topic, depth)
+        deadline = time.monotonic() + self.discovery_timeout
+        while publisher.get_subscription_count() == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return publisher
 
-        if ros_obj._fields_and_field_types.keys() != json_args.keys():
-            raise KeyError(f"payload does not contain correct keys for {ros_obj.__class__.__name__}")
 
-        for field, field_type in ros_obj._fields_and_field_types.items():
-               
-            is_sequence = False
-            
-            # Is the field type a sequence, if so extract type from angle brackets
-            if field_type.startswith("sequence"):
-                field_type = field_type.split('sequence')[1][1:-1]
-                is_sequence = True
-            
-            # If the field is a primative we can set it directly from the json
-            if field_type in self.primitives:
-                if not is_sequence and field_type in self.float_types:
-                    json_args[field] = float(json_args[field])
-                ros_obj.__setattr__(field, json_args[field])
-            
-            # If not we need to dynamically load the non primitive field type
-            else:
-                field_module_name, field_class_name = field_type.split("/")
-                field_module = importlib.import_module(f'{field_module_name}.{ros_inter}')
-                nested_msg = getattr(field_module, field_class_name)()
-
-                # If not a sequence, we set the field to the result of the recursion
-                if is_sequence == False:
-                    ros_obj.__setattr__(field, self.derserialize_json(nested_msg, ros_inter, json_args[field]))
-                
-
-                # If it is a sequence, we set the field to the result of the list of recursions
-                else:
-                    nested_msgs = []
-                    for elem in json_args[field]:
-                        nested_msgs.append(self.derserialize_json(nested_msg, ros_inter, elem))
-                    ros_obj.__setattr__(field, nested_msgs)
-        
-        return ros_obj
\ No newline at end of file
+    def create_client(self, srv_class, srv_name):
+        client = self.node.create_client(srv_class, srv_name, callback_group=self.commands_group)
+        client.wait_for_service(timeout_sec=self.discovery_timeout)
+        return client
+
+
+    def create_action_client(self, action_class, act_name):
+        client = ActionClient(self.node, action_class, act_name, callback_group=self.commands_group)
+        client.wait_for_server(timeout_sec=self.discovery_timeout)
+        return client
@@ -0,0 +1,213 @@
+import hashlib
+import importlib
+import threading
+import time
+from jsonschema import Draft7Validator
+from rosidl_parser.definition import (
+    AbstractNestedType,
+    AbstractString,
+    AbstractWString,
+    Array,
+    BasicType,
+    BoundedSequence,
+    NamespacedType,
+)
+from rosidl_runtime_py.import_message import import_message_from_namespaced_type
+from agent import message_converter
+
+
+class AirTypeRegistry:
+    """
+    Resolves ROS message, service and action type names to their classes and caches them
+    together with metadata derived from the type definitions.
+
+    Types are given as <package>/<interface>/<name> or <package>/<name>, the interface
+    (msg, srv or action) is chosen by the caller. A type that fails to resolve is reported
+    once and the error is raised again for lookups within FAILURE_TTL seconds without
+    importing, after that the import is retried, e.g. for a package sourced later.
+    """
+
+    KINDS = ('msg', 'srv', 'action')
+
+    # Seconds a failed lookup is remembered before the type is imported again
+    FAILURE_TTL = 30
+
+    FLOAT_TYPES = ('float', 'double', 'long double')
+
+    TYPED_ARRAY_SCHEMA = {
+        'type': 'object',
+        'properties': {
+            'dtype': { 'type': 'string' },
+            'shape': { 'type': 'array', 'items': { 'type': 'integer' } },
+            'data': { 'type': 'string' }
+        },
+        'required': ['dtype', 'data']
+    }
+
+    # Inclusive value ranges of the integer types
+    INTEGER_RANGES = {
+        'int8': (-2**7, 2**7 - 1),
+        'uint8': (0, 2**8 - 1),
+        'int16': (-2**15, 2**15 - 1),
+        'uint16': (0, 2**16 - 1),
+        'int32': (-2**31, 2**31 - 1),
+        'uint32': (0, 2**32 - 1),
+        'int64': (-2**63, 2**63 - 1),
+        'uint64': (0, 2**64 - 1),
+        'short': (-2**15, 2**15 - 1),
+        'unsigned short': (0, 2**16 - 1),
+        'long': (-2**31, 2**31 - 1),
+        'unsigned long': (0, 2**32 - 1),
+        'long long': (-2**63, 2**63 - 1),
+        'unsigned long long': (0, 2**64 - 1),
+    }
+
+    def __init__(self, logger) -> None:
+        self.logger = logger
+        self.classes = {}
+        self.failures = {}
+        self.type_hashes = {}
+        self.validators = {}
+        self.lock = threading.Lock()
+
+
+    def resolve(self, type_name: str, kind: str = 'msg'):
+        key = (type_name, kind)
+        type_class = self.classes.get(key)
+        if type_class is not None:
+            return type_class
+
+        with self.lock:
+            failure = self.failures.get(key)
+            if failure is not None:
+                failed_at, error_class, message = failure
+                if time.monotonic() - failed_at < self.FAILURE_TTL:
+                    raise error_class(message)
+                del self.failures[key]
+
+            try:
+                parts = type_name.split('/')
+                mod = importlib.import_module(f'{parts[0]}.{kind}')
+                type_class = getattr(mod, parts[-1])
+            except (ImportError, AttributeError) as e:
+                self.failures[key] = (time.monotonic(), type(e), str(e))
+                self.logger.error(f'unable to resolve {kind} type {type_name}: {e}')
+                raise
+
+            self.classes[key] = type_class
+            return type_class
+
+
+    def prewarm(self, type_names):
+        '''
+        Resolve types and compile their serializers ahead of the first message. Names without
+        an interface part, or with msg, are treated as messages.
+        '''
+        for type_name in type_names:
+            parts = type_name.split('/')
+            kind = parts[1] if len(parts) == 3 and parts[1] in self.KINDS else 'msg'
+            try:
+                type_class = self.resolve(type_name, kind)
+                if kind == 'msg':
+                    message_converter.get_message_serializer(type_class, base64_encoding=False)
+                    self.type_hash(type_class)
+                    self.payload_validator(type_class)
+            except (ImportError, AttributeError):
+                continue
+            except:
+                self.logger.exception(f'unable to prewarm type {type_name}')
+                continue
+            self.logger.debug(f'prewarmed {kind} type {type_name}')
+
+
+    def type_hash(self, msg_class):
+        '''
+        Humble has no type hashes, so hash the field types and names of the message and
+        every message nested in it. The hash changes whenever the CDR layout changes.
+        '''
+        if msg_class not in self.type_hashes:
+            definitions = {}
+            self.collect_definitions(msg_class, definitions)
+            text = '\n'.join(f'{name}\n{definition}' for name, definition in sorted(definitions.items()))
+            self.type_hashes[msg_class] = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return self.type_hashes[msg_class]
+
+
+    def collect_definitions(self, msg_class, definitions):
+        name = f"{msg_class.__module__.split('.')[0]}/msg/{msg_class.__name__}"
+        if name in definitions:
+            return
+
+        fields = msg_class.get_fields_and_field_types()
+        definitions[name] = '\n'.join(f'{field_type} {field}' for field, field_type in fields.items())
+
+        for slot_type in msg_class.SLOT_TYPES:
+            if isinstance(slot_type, AbstractNestedType):
+                slot_type = slot_type.value_type
+            if isinstance(slot_type, NamespacedType):
+                self.collect_definitions(import_message_from_namespaced_type(slot_type), definitions)
+
+
+    def payload_validator(self, msg_class):
+        '''
+        Returns a compiled JSON schema validator for dictionaries converted into msg_class,
+        so malformed payloads are rejected before any message is constructed.
+        '''
+        validator = self.validators.get(msg_class)
+        if validator is None:
+            validator = Draft7Validator(self.message_schema(msg_class))
+            self.validators[msg_class] = validator
+        return validator
+
+
+    def message_schema(self, msg_class):
+        # Fields are optional and may be null, like in message_converter.set_message_fields
+        return {
+            'type': 'object',
+            'properties': {
+                slot[1:]: self.field_schema(slot_type) for slot, slot_type in zip(msg_class.__slots__, msg_class.SLOT_TYPES)
+            },
+            'additionalProperties': False
+        }
+
+
+    def field_schema(self, slot_type):
+        if isinstance(slot_type, NamespacedType):
+            return { 'anyOf': [self.message_schema(import_message_from_namespaced_type(slot_type)), { 'type': 'null' }] }
+
+        if isinstance(slot_type, (AbstractString, AbstractWString)):
+            schema = { 'type': ['string', 'null'] }
+            if getattr(slot_type, 'maximum_size', None) is not None:
+                schema['maxLength'] = slot_type.maximum_size
+            return schema
+
+        if isinstance(slot_type, BasicType):
+            if slot_type.typename == 'boolean':
+                return { 'type': ['boolean', 'null'] }
+            if slot_type.typename in self.FLOAT_TYPES:
+                return { 'type': ['number', 'null'] }
+            if slot_type.typename in self.INTEGER_RANGES:
+                minimum, maximum = self.INTEGER_RANGES[slot_type.typename]
+                return { 'type': ['integer', 'null'], 'minimum': minimum, 'maximum': maximum }
+            return {}
+
+        if isinstance(slot_type, AbstractNestedType):
+            schema = { 'type': ['array', 'null'], 'items': self.field_schema(slot_type.value_type) }
+            if isinstance(slot_type, Array):
+                schema['minItems'] = schema['maxItems'] = slot_type.size
+            elif isinstance(slot_type, BoundedSequence):
+                schema['maxItems'] = slot_type.maximum_size
+
+            if not isinstance(slot_type.value_type, BasicType):
+                return schema
+
+            # Numeric arrays may also be sent with the typed array encoding, byte arrays Base64 encoded
+            alternatives = [schema]
+            typename = slot_type.value_type.typename
+            if typename in self.FLOAT_TYPES or typename in self.INTEGER_RANGES:
+                alternatives.append(self.TYPED_ARRAY_SCHEMA)
+            if typename in ('uint8', 'octet'):
+                alternatives.append({ 'type': 'string' })
+            return { 'anyOf': alternatives } if len(alternatives) > 1 else schema
+
+        return {}
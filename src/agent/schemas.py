@@ -1,4 +1,4 @@
-from jsonschema import validate, ValidationError
+from jsonschema import Draft7Validator
 
 # Command
 command_schema = {
@@ -31,4 +31,34 @@ container_update_schema = {
         }
     },
     "required": ["compose" ]
-}
\ No newline at end of file
+}
+
+
+# Log configuration
+log_level_schema = {
+    "type": "string",
+    "enum": ["debug", "info", "warn", "error", "fatal"]
+}
+
+log_config_schema = {
+    "type": "object",
+    "properties": {
+        "enabled": {"type": "boolean"},
+        "level": log_level_schema,
+        "node_levels": {
+            "type": "object",
+            "additionalProperties": log_level_schema
+        },
+        "nodes": {"type": "array", "items": {"type": "string"}},
+        "exclude_nodes": {"type": "array", "items": {"type": "string"}},
+        "messages": {"type": "array", "items": {"type": "string", "format": "regex"}},
+        "exclude_messages": {"type": "array", "items": {"type": "string", "format": "regex"}}
+    },
+    "required": ["enabled"]
+}
+
+
+# Validators are compiled once and reused for every message
+command_validator = Draft7Validator(command_schema)
+container_update_validator = Draft7Validator(container_update_schema)
+log_config_validator = Draft7Validator(log_config_schema)
@@ -0,0 +1,42 @@
+import math
+import threading
+from collections import deque
+
+
+class AirTimeSeries:
+    """
+    Keeps the last size samples of every metric in a ring buffer and summarises them.
+
+    Metrics are added by name the first time they are sampled. summary() returns the
+    min, max, mean and 95th percentile of the buffered samples of every metric.
+    """
+
+    def __init__(self, size) -> None:
+        self.size = max(1, int(size))
+        self.series = {}
+        self.lock = threading.Lock()
+
+
+    def add(self, samples: dict):
+        with self.lock:
+            for name, value in samples.items():
+                values = self.series.get(name)
+                if values is None:
+                    values = deque(maxlen=self.size)
+                    self.series[name] = values
+                values.append(value)
+
+
+    def summary(self, digits=2):
+        with self.lock:
+            series = { name: sorted(values) for name, values in self.series.items() if values }
+
+        return {
+            name: {
+                'min': round(values[0], digits),
+                'max': round(values[-1], digits),
+                'mean': round(sum(values) / len(values), digits),
+                'p95': round(values[math.ceil(0.95 * len(values)) - 1], digits)
+            }
+            for name, values in series.items()
+        }
@@ -5,52 +5,262 @@ import threading
 from agent.logger import AirLogger
 import socket
 import urllib.request
+from agent.timeseries import AirTimeSeries
+from agent.resources import AirResources
+
 
 class AirVitals:
+    """
+    Samples system vitals with collectors that each run at their own period.
+
+    A collector returns the vitals it measured and they are cached until its next run, so
+    the period doubles as the TTL of the values. Slow collectors run on a background thread
+    with at most one run in flight and never stall the loop, which publishes the cached
+    vitals every vitals.period seconds. On Linux the local IP is refreshed when a netlink
+    message reports an IPv4 address change, the period is only a fallback. The public IP is
+    refreshed on such a change at most once per tenth of its period.
+
+    Only vitals that changed since the last message are sent, numbers must change by at least
+    min_change, with a full message every keyframe_period seconds and when publishing is
+    enabled. Per core CPU, memory, network and disk I/O rates and temperatures are kept in a
+    time series covering window seconds, whose min, max, mean and p95 are sent as summary
+    once per window. The top consumers among ROS node processes and compose managed
+    containers are sent as processes and containers.
+    """
 
-    vitals = {
-        'cpu': 0,
-        'ram': 0,
-        'disk': 0,
-        'battery': 0,
-        'local_ip': '',
-        'public_ip': '',        
-    }
+    # Netlink multicast group of IPv4 address changes. Links and IPv6 addresses are left out, docker
+    # adds and removes a veth link with an IPv6 link local address for every container it starts
+    RTMGRP_IPV4_IFADDR = 0x10
 
-    def __init__(self, config, on_vitals) -> None:   	
+    def __init__(self, config, on_vitals, docker_client=None) -> None:
         self.logger = AirLogger(__name__, config).logger
         self.on_vitals = on_vitals
+        self.period = float(config['vitals']['period'])
+        self.public_ip_timeout = float(config['vitals']['public_ip_timeout'])
+        self.window = float(config['vitals']['window'])
+        self.keyframe_period = float(config['vitals']['keyframe_period'])
+        self.min_change = float(config['vitals']['min_change'])
+        self.series = AirTimeSeries(self.window / float(config['vitals']['series_period']))
+        self.counters = None
+        self.sent = {}
+        self.next_keyframe = 0
+        self.publishing = False
+        self.next_summary = time.monotonic() + self.window
+        self.lock = threading.Lock()
+        self.collectors = []
+        self.vitals = {
+            'cpu': 0,
+            'ram': 0,
+            'disk': 0,
+            'battery': 0,
+            'local_ip': '',
+            'public_ip': '',
+        }
+
+        self.add_collector('cpu', self.collect_cpu, config['vitals']['cpu_period'])
+        self.add_collector('ram', self.collect_ram, config['vitals']['ram_period'])
+        self.add_collector('disk', self.collect_disk, config['vitals']['disk_period'])
+        self.add_collector('battery', self.collect_battery, config['vitals']['battery_period'])
+        self.add_collector('local_ip', self.collect_local_ip, config['vitals']['local_ip_period'], background=True)
+        self.add_collector('public_ip', self.collect_public_ip, config['vitals']['public_ip_period'], background=True)
+        self.add_collector('series', self.collect_series, config['vitals']['series_period'])
+
+        self.resources = AirResources(config, docker_client)
+        self.add_collector('processes', self.resources.collect_processes, config['vitals']['processes_period'])
+        self.add_collector('containers', self.resources.collect_containers, config['vitals']['containers_period'],
+                           background=True)
 
         if config['enable_vitals']:
             self.logger.debug('vitals enabled')
             vitals_thread = threading.Thread(target=self.monitor_vitals, daemon=True)
             vitals_thread.start()
-        else: 
+            interfaces_thread = threading.Thread(target=self.watch_interfaces, daemon=True)
+            interfaces_thread.start()
+        else:
             self.logger.debug('vitals disabled')
 
-    
+
+    def add_collector(self, name, collect, period, background=False):
+        self.collectors.append({
+            'name': name,
+            'collect': collect,
+            'period': float(period),
+            'background': background,
+            'running': False,
+            'next_run': 0
+        })
+
+
     def monitor_vitals(self):
-        
+        next_publish = time.monotonic()
+
         while True:
+            now = time.monotonic()
+            for collector in self.collectors:
+                if collector['next_run'] <= now:
+                    collector['next_run'] = now + collector['period']
+                    self.run_collector(collector)
+
+            # Only encode while publishing, so every delta is relative to a message the cloud received
+            with self.lock:
+                publishing = self.publishing
+                vitals = dict(self.vitals)
+            message = self.encode(vitals, now) if publishing else None
+            if message:
+                self.on_vitals(message)
+
+            # Sleep until the next tick, without drifting by the time spent collecting
+            next_publish += self.period
+            time.sleep(max(0, next_publish - time.monotonic()))
+
+
+    def set_publishing(self, publishing):
+        with self.lock:
+            if publishing and not self.publishing:
+                self.next_keyframe = 0
+            self.publishing = publishing
+
+
+    def encode(self, vitals, now):
+        full = now >= self.next_keyframe
+        if full:
+            changed = vitals
+            self.next_keyframe = now + self.keyframe_period
+        else:
+            changed = { name: value for name, value in vitals.items() if self.has_changed(name, value) }
+        self.sent.update(changed)
+
+        message = dict(changed)
+        if now >= self.next_summary:
+            message['summary'] = self.series.summary()
+            self.next_summary = now + self.window
+
+        if not message:
+            return None
+        message['full'] = full
+        return message
+
+
+    def has_changed(self, name, value):
+        sent = self.sent.get(name)
+        if isinstance(value, (int, float)) and isinstance(sent, (int, float)):
+            return abs(value - sent) >= self.min_change
+        return value != sent
+
+
+    def run_collector(self, collector):
+        if not collector['background']:
+            self.collect(collector)
+            return
+
+        with self.lock:
+            if collector['running']:
+                return
+            collector['running'] = True
+        threading.Thread(target=self.collect, args=(collector,), daemon=True).start()
+
+
+    def collect(self, collector):
+        try:
+            values = collector['collect']()
+            with self.lock:
+                self.vitals.update(values)
+        except:
+            self.logger.exception(f"unable to collect {collector['name']} vitals")
+        finally:
+            collector['running'] = False
+
+
+    def collect_cpu(self):
+        # Non blocking, measures the usage since the previous call
+        return { 'cpu': psutil.cpu_percent() }
+
+
+    def collect_ram(self):
+        return { 'ram': psutil.virtual_memory().percent }
+
+
+    def collect_disk(self):
+        usage = shutil.disk_usage('/')
+        return { 'disk': round((usage.used / usage.total)*100, 2) }
+
+
+    def collect_battery(self):
+        battery = psutil.sensors_battery()
+        return { 'battery': round(battery.percent, 2) } if battery else {}
+
+
+    def collect_local_ip(self):
+        try:
+            return { 'local_ip': socket.gethostbyname(socket.gethostname()) }
+        except socket.gaierror:
+            self.logger.warning('unable to get local IP')
+            return {}
+
+
+    def collect_public_ip(self):
+        try:
+            with urllib.request.urlopen('https://ident.me', timeout=self.public_ip_timeout) as response:
+                return { 'public_ip': response.read().decode('utf8') }
+        except:
+            self.logger.warning('unable to get public IP')
+            return {}
+
+
+    def collect_series(self):
+        samples = { f'cpu_{core}': percent for core, percent in enumerate(psutil.cpu_percent(percpu=True)) }
+        memory = psutil.virtual_memory()
+        samples['ram'] = memory.percent
+        samples['ram_used_mb'] = memory.used / 2**20
+
+        # I/O counters only ever grow, sample their rate of change since the last run
+        now = time.monotonic()
+        net = psutil.net_io_counters()
+        disk = psutil.disk_io_counters()
+        counters = {
+            'net_sent_bps': net.bytes_sent if net else None,
+            'net_recv_bps': net.bytes_recv if net else None,
+            'disk_read_bps': disk.read_bytes if disk else None,
+            'disk_write_bps': disk.write_bytes if disk else None
+        }
+        if self.counters is not None:
+            last_counters, last_now = self.counters
+            for name, value in counters.items():
+                if value is not None and last_counters[name] is not None and now > last_now:
+                    samples[name] = max(0, value - last_counters[name]) / (now - last_now)
+        self.counters = (counters, now)
+
+        if hasattr(psutil, 'sensors_temperatures'):
+            for sensor, temps in psutil.sensors_temperatures().items():
+                for index, temp in enumerate(temps):
+                    samples[f'temp_{sensor}_{temp.label or index}'] = temp.current
+
+        self.series.add(samples)
+        return {}
+
 
-            self.vitals['cpu'] = psutil.cpu_percent()
-            self.vitals['ram'] = psutil.virtual_memory().percent
-            self.vitals['disk'] = round((shutil.disk_usage('/').used / shutil.disk_usage('/').total)*100, 2)
+    def watch_interfaces(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, self.RTMGRP_IPV4_IFADDR))
+        except (AttributeError, OSError):
+            self.logger.debug('netlink unavailable, polling the local IP')
+            return
 
-            if psutil.sensors_battery():
-                self.vitals['battery'] = round(psutil.sensors_battery().percent, 2)
-        
-            try:
-                self.vitals['local_ip'] = socket.gethostbyname(socket.gethostname())
-            except socket.gaierror:
-                self.logger.warning('unable to get local IP')
+        local_ip = next(collector for collector in self.collectors if collector['name'] == 'local_ip')
+        public_ip = next(collector for collector in self.collectors if collector['name'] == 'public_ip')
 
-            try: 
-                self.vitals['public_ip'] = urllib.request.urlopen('https://ident.me').read().decode('utf8')
-            except: 
-                self.logger.warning('unable to get public IP')
+        public_ip_debounce = public_ip['period'] / 10
+        public_ip_refreshed = 0
 
-            self.on_vitals(self.vitals)
-    
-            time.sleep(1)
+        with sock:
+            while True:
+                sock.recv(65536)
+                self.logger.debug('network addresses changed')
+                local_ip['next_run'] = 0
 
+                # An address change can also change the public IP, but it is an HTTPS request
+                now = time.monotonic()
+                if now - public_ip_refreshed >= public_ip_debounce:
+                    public_ip_refreshed = now
+                    public_ip['next_run'] = 0
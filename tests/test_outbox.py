@@ -0,0 +1,39 @@
+import pytest
+from agent.outbox import AirOutbox
+
+
+CONFIG = {
+    'debug': False,
+    'daemonize': True,
+    'offline': {
+        'max_bytes': 1000,
+        'drain_rate': 50
+    }
+}
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch):
+    monkeypatch.setattr(AirOutbox, 'DB_PATH', str(tmp_path / 'outbox.db'))
+    return AirOutbox(CONFIG, lambda *args: True)
+
+
+def row_ids(outbox):
+    return [row[0] for row in outbox.db.execute('SELECT id FROM messages ORDER BY id')]
+
+
+def test_put_evicts_only_the_oldest_messages(outbox):
+    # Every message takes 90 + 2 + 11 = 103 bytes, so 9 fit in 1000 bytes
+    for _ in range(12):
+        outbox.put('data/ingest', b'x' * 90, 1)
+
+    assert row_ids(outbox) == list(range(4, 13))
+    assert outbox.size == 9 * 103
+
+
+def test_put_keeps_the_new_message_when_it_alone_exceeds_max_bytes(outbox):
+    outbox.put('data/ingest', b'x' * 90, 1)
+    outbox.put('data/ingest', b'x' * 2000, 1)
+
+    assert row_ids(outbox) == [2]
+    assert outbox.size == 2000 + 2 + 11